@@ -1,19 +1,82 @@
 from logging import DEBUG, INFO, WARNING, ERROR
 from os.path import abspath, join
-from os import getcwd
+from os import getcwd, environ, cpu_count
 
 
 class Config:
     BOT_TOKEN = ""
     SERVER_PORT = 5000
 
+    # Can be pointed to a local Bot API server (or the load test stub)
+    TELEGRAM_API = environ.get("TELEGRAM_API", "https://api.telegram.org")
+    # The Bot API server is started with --local and shares the file system with the bot
+    LOCAL_API_MODE = environ.get("LOCAL_API_MODE", "") == "1"
+
+    # Size limits in bytes, local limits are used in LOCAL_API_MODE
+    MAX_DOWNLOAD_SIZE = 2 * 1000 * 1000
+    MAX_UPLOAD_SIZE = 50 * 1000 * 1000
+    LOCAL_MAX_DOWNLOAD_SIZE = 2000 * 1000 * 1000
+    LOCAL_MAX_UPLOAD_SIZE = 2000 * 1000 * 1000
+
     BASE_DIR = abspath(getcwd())
 
     TEMP_FOLDER = "temp"
 
+    # Videos longer than FRAME_SEGMENT_MIN_FRAMES per worker are framed in parallel
+    FRAME_WORKERS = cpu_count() or 1
+    FRAME_SEGMENT_MIN_FRAMES = 500
+    FRAME_INTERVAL_SECONDS = 1.0
+    FRAME_MAX_COUNT = 100
+    # Scene change detection compares brightness histograms of thumbnails (distance from 0 to 1)
+    FRAME_SCENE_THRESHOLD = 0.3
+    FRAME_SCENE_CHECKS_PER_SECOND = 5
+    FRAME_SCENE_SIZE = (64, 36)
+    SHEET_COLUMNS = 4
+    SHEET_ROWS = 4
+    SHEET_TILE_WIDTH = 320
+    SHEET_FORMAT = "jpeg"
+
+    ANIMATION_MAX_FPS = 15
+    ANIMATION_MAX_SIZE = 512
+    ANIMATION_MAX_FRAMES = 300
+
+    # Limits of a conversion worker process (0 disables a limit)
+    CONVERSION_TIMEOUT = 300
+    CONVERSION_MAX_CPU_SECONDS = 600
+    CONVERSION_MAX_MEMORY = 2 * 1024 * 1024 * 1024
+    CONVERSION_MAX_OUTPUT_SIZE = 4 * 1000 * 1000 * 1000
+    CONVERSION_NICENESS = 5
+    IMAGE_MAX_PIXELS = 50 * 1000 * 1000
+    # Seconds a cancelled conversion worker has to stop by itself before it is killed
+    CANCELLATION_GRACE = 2
+
+    # Conversions run at once, the shortest estimated first
+    CONVERSION_WORKERS = max(1, (cpu_count() or 1) // 2)
+    # Seconds taken off the estimate of a waiting conversion per second of waiting
+    SCHEDULER_AGING = 1.0
+    # Estimates are fitted on timings once a conversion has COST_MODEL_MIN_SAMPLES of them,
+    # before that a planned cost unit counts as COST_MODEL_SECONDS_PER_COST
+    COST_MODEL_MIN_SAMPLES = 5
+    COST_MODEL_SECONDS_PER_COST = 1.0
+    COST_MODEL_MIN_SECONDS = 0.1
+    COST_MODEL_DECAY = 0.98
+    COST_MODEL_RIDGE = 0.1
+
     LOGGING_FOLDER = join(BASE_DIR, "log")
     LOGGING_PATH = join(LOGGING_FOLDER, "log.log")
     LOGGING_FILE_LEVEL = DEBUG
     LOGGING_COMMAND_LINE_LEVEL = DEBUG
+    LOGGING_MAX_BYTES = 10 * 1024 * 1024
+    LOGGING_BACKUP_COUNT = 5
+    LOGGING_JSON = False
 
     ADMIN_TELEGRAM_ID = 0
+
+    # Webhook retries of processed updates are answered without converting again
+    UPDATE_CACHE_SIZE = 10000
+    UPDATE_HISTORY_HOURS = 24
+    UPDATE_PRUNE_INTERVAL = 1000
+    # Seconds a retry of an update in progress waits for it before answering
+    UPDATE_ATTACH_TIMEOUT = 10
+    # Seconds after which an update still processing is considered abandoned and processed again
+    UPDATE_STALE_SECONDS = 600
@@ -0,0 +1,267 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+
+import cv2
+import numpy
+from flask import Flask, request, abort, send_file
+
+
+class FakeTelegramApi:
+    """
+    Local stub of the telegram bot api used for load testing
+    Implements getFile, file download, sendMessage and sendDocument
+    Every file id is served from one of generated fixtures,
+    the fixture is encoded in the file id prefix (for example png_1f2e...)
+    Collects counters which can be read by the harness at /stats
+    Records when a chat gets its last document or an error answer,
+    the harness waits for it at /completion to measure conversions end to end
+    A part of a split archive (name.partN.zip) is the last document only if it has a caption,
+    the bot sends the last part with the number of parts
+    With local set behaves like a Bot API server started with --local:
+    getFile returns absolute paths and sendDocument accepts file:// uris
+    """
+    ERROR_PHRASES = ("error", "not_supported_format", "wrong_format", "unknown_user", "no_file",
+                     "conversion_limit", "output_too_big")
+    PART_NAME = re.compile(r"\.part\d+\.zip$")
+
+    def __init__(self, token, fixture_folder, phrases_path="phrases.json", latency=0.0, local=False):
+        self.token = token
+        self.local = local
+        self.fixture_folder = os.path.abspath(fixture_folder)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.completed = threading.Condition(self.lock)
+        self.completions = {}
+        self.stats = self.empty_stats()
+        self.error_texts = self.read_error_texts(phrases_path)
+
+        if not os.path.exists(self.fixture_folder):
+            os.makedirs(self.fixture_folder)
+        self.fixtures = self.generate_fixtures()
+
+        self.app = Flask(__name__)
+        self.add_routes()
+
+    @staticmethod
+    def empty_stats():
+        """
+        Returns zeroed counters
+        :return: dict
+        """
+        return {
+            "get_file": 0,
+            "downloads": 0,
+            "downloaded_bytes": 0,
+            "messages": 0,
+            "error_messages": 0,
+            "documents": 0,
+            "parts": 0,
+            "uploaded_bytes": 0,
+        }
+
+    def read_error_texts(self, phrases_path):
+        """
+        Reads bot phrases to recognise error answers sent with sendMessage
+        :param phrases_path: str
+        :return: set
+        """
+        if not os.path.exists(phrases_path):
+            return set()
+        with open(phrases_path, "r", encoding="utf-8") as f:
+            phrases = json.load(f)
+        return {
+            text
+            for action in self.ERROR_PHRASES if action in phrases
+            for text in phrases[action].values()
+        }
+
+    def generate_fixtures(self):
+        """
+        Creates an image, a markdown document and a short video served as uploaded files
+        :return: dict
+        """
+        fixtures = {}
+
+        image_path = os.path.join(self.fixture_folder, "fixture.png")
+        gradient = numpy.linspace(0, 255, 640, dtype=numpy.uint8)
+        image = numpy.dstack([numpy.tile(gradient, (480, 1))] * 3)
+        cv2.imwrite(image_path, image)
+        fixtures["png"] = image_path
+
+        document_path = os.path.join(self.fixture_folder, "fixture.markdown")
+        with open(document_path, "w", encoding="utf-8") as f:
+            for section in range(20):
+                f.write(f"# Section {section}\n\n")
+                f.write("Lorem ipsum dolor sit amet, *consectetur* adipiscing elit.\n\n")
+                f.write("- first\n- second\n- third\n\n")
+        fixtures["markdown"] = document_path
+
+        video_path = os.path.join(self.fixture_folder, "fixture.mp4")
+        writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*"mp4v"), 24, (320, 240))
+        for count in range(48):
+            frame = numpy.full((240, 320, 3), count * 5 % 255, dtype=numpy.uint8)
+            cv2.putText(frame, str(count), (20, 120), cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+            writer.write(frame)
+        writer.release()
+        fixtures["mp4"] = video_path
+
+        return fixtures
+
+    def fixture_format(self, file_id):
+        """
+        Returns a fixture format encoded in the file id
+        :param file_id: str
+        :return: str
+        """
+        file_format = file_id.split("_")[0]
+        if file_format not in self.fixtures:
+            abort(400)
+        return file_format
+
+    def count(self, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                self.stats[name] += value
+
+    def complete(self, chat_id, kind):
+        """
+        Records a document or an error answer sent to a chat
+        :param chat_id: str
+        :param kind: str
+        :return: None
+        """
+        with self.completed:
+            self.completions.setdefault(chat_id, []).append((time.time(), kind))
+            self.completed.notify_all()
+
+    def wait_completion(self, chat_id, since, timeout):
+        """
+        Waits for the first completion of a chat at or after since (unix time)
+        Older completions of the chat are forgotten
+        Returns (time, kind) or None after timeout seconds
+        :param chat_id: str
+        :param since: float
+        :param timeout: float
+        :return: tuple
+        """
+        deadline = time.monotonic() + timeout
+        with self.completed:
+            while True:
+                events = [event for event in self.completions.get(chat_id, []) if event[0] >= since]
+                self.completions[chat_id] = events
+                if events:
+                    return events[0]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.completed.wait(remaining)
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add_routes(self):
+        """
+        Registers telegram api routes
+        :return: None
+        """
+        bot_prefix = f"/bot{self.token}"
+
+        @self.app.route(f"{bot_prefix}/getFile")
+        def get_file():
+            self.delay()
+            file_id = request.args["file_id"]
+            file_format = self.fixture_format(file_id)
+            self.count(get_file=1)
+            if self.local:
+                file_path = self.fixtures[file_format]
+            else:
+                file_path = f"documents/{file_id}.{file_format}"
+            return {"ok": True, "result": {
+                "file_id": file_id,
+                "file_size": os.path.getsize(self.fixtures[file_format]),
+                "file_path": file_path
+            }}
+
+        @self.app.route(f"/file{bot_prefix}/documents/<file_name>")
+        def download(file_name):
+            self.delay()
+            file_format = self.fixture_format(file_name)
+            path = self.fixtures[file_format]
+            self.count(downloads=1, downloaded_bytes=os.path.getsize(path))
+            return send_file(path)
+
+        @self.app.route(f"{bot_prefix}/sendMessage", methods=["POST"])
+        def send_message():
+            self.delay()
+            text = request.form.get("text", "")
+            is_error = text in self.error_texts
+            self.count(messages=1, error_messages=int(is_error))
+            if is_error:
+                self.complete(request.form.get("chat_id", ""), "error")
+            return {"ok": True, "result": {}}
+
+        @self.app.route(f"{bot_prefix}/sendDocument", methods=["POST"])
+        def send_document():
+            self.delay()
+            if request.mimetype == "multipart/form-data":
+                document = request.files.get("document")
+                if document is None:
+                    abort(400)
+                size = document.stream.seek(0, os.SEEK_END)
+                file_name = document.filename or ""
+            else:
+                document = request.form.get("document", "")
+                if not self.local or not document.startswith("file://"):
+                    abort(400)
+                size = os.path.getsize(document[len("file://"):])
+                file_name = os.path.basename(document)
+            is_part = bool(self.PART_NAME.search(file_name)) and not request.form.get("caption")
+            self.count(documents=1, parts=int(is_part), uploaded_bytes=size)
+            if not is_part:
+                self.complete(request.form.get("chat_id", ""), "document")
+            return {"ok": True, "result": {}}
+
+        @self.app.route("/completion")
+        def completion():
+            event = self.wait_completion(request.args["chat_id"], float(request.args.get("since", 0)),
+                                         float(request.args.get("timeout", 60)))
+            if event is None:
+                return {"ok": False}
+            return {"ok": True, "result": {"time": event[0], "kind": event[1]}}
+
+        @self.app.route("/stats")
+        def stats():
+            with self.lock:
+                return dict(self.stats)
+
+        @self.app.route("/stats/reset", methods=["POST"])
+        def reset_stats():
+            with self.lock:
+                self.stats = self.empty_stats()
+            return {"ok": True}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake telegram bot api for load testing")
+    parser.add_argument("--token", default="", help="bot token the bot is configured with")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--fixtures", default=os.path.join("temp", "load_test_fixtures"),
+                        help="folder to generate fixtures in")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds added to every api call to simulate network latency")
+    parser.add_argument("--local", action="store_true",
+                        help="behave like a Bot API server started with --local (use with LOCAL_API_MODE=1)")
+    args = parser.parse_args()
+
+    api = FakeTelegramApi(args.token, args.fixtures, latency=args.latency, local=args.local)
+    api.app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
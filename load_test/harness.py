@@ -0,0 +1,364 @@
+import argparse
+import itertools
+import json
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+class Scenario:
+    """
+    A user session replayed by the harness
+    An upload of a fixture followed by a format reply
+    """
+    def __init__(self, name, fixture, file_name, reply):
+        self.name = name
+        self.fixture = fixture
+        self.file_name = file_name
+        self.reply = reply
+
+
+SCENARIOS = {
+    "image": Scenario("image", "png", "image.png", "jpeg"),
+    "image_webp": Scenario("image_webp", "png", "image.png", "webp"),
+    "document": Scenario("document", "markdown", "document.markdown", "html"),
+    "document_docx": Scenario("document_docx", "markdown", "document.markdown", "docx"),
+    "video": Scenario("video", "mp4", "video.mp4", "frame"),
+}
+
+
+class ProcessSampler:
+    """
+    Samples cpu time and resident memory of the bot processes from /proc
+    Children of supplied pids (gunicorn workers) are included
+    """
+    CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+    PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def __init__(self, pids, interval=0.5):
+        self.pids = pids
+        self.interval = interval
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def expand_pids(self):
+        pids = set()
+        for pid in self.pids:
+            pids.add(pid)
+            try:
+                for task in os.listdir(f"/proc/{pid}/task"):
+                    with open(f"/proc/{pid}/task/{task}/children") as f:
+                        pids.update(int(child) for child in f.read().split())
+            except OSError:
+                continue
+        return pids
+
+    def cpu_seconds(self):
+        total = 0
+        for pid in self.expand_pids():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            total += int(fields[11]) + int(fields[12])
+        return total / self.CLOCK_TICKS
+
+    def rss(self):
+        total = 0
+        for pid in self.expand_pids():
+            try:
+                with open(f"/proc/{pid}/statm") as f:
+                    total += int(f.read().split()[1]) * self.PAGE_SIZE
+            except OSError:
+                continue
+        return total
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, self.rss())
+
+    def start(self):
+        self.peak_rss = self.rss()
+        self.start_cpu = self.cpu_seconds()
+        self.start_time = time.perf_counter()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops sampling and returns the used resources
+        :return: dict
+        """
+        self._stop.set()
+        self._thread.join()
+        elapsed = time.perf_counter() - self.start_time
+        cpu = self.cpu_seconds() - self.start_cpu
+        return {
+            "cpu_percent": round(100 * cpu / elapsed, 1) if elapsed else 0.0,
+            "peak_rss_mb": round(self.peak_rss / 2 ** 20, 1),
+        }
+
+
+class LoadHarness:
+    """
+    Replays a mix of webhook updates against the bot at increasing concurrency
+    Every virtual user sends an upload and then a format reply
+    The webhook answers a format reply once the conversion is queued,
+    so a conversion counts as done when the fake api gets its last document or an error answer
+    (convert_* latency, webhook_* is the webhook answer only)
+    A virtual user runs one session at a time, a new upload would cancel its conversion
+    Reports throughput, latency percentiles per message type, error rates and resource usage
+    """
+    def __init__(self, app_url, api_url, users, mix, timeout=300.0, pids=()):
+        self.app_url = app_url
+        self.api_url = api_url
+        self.users = users
+        self.mix = mix
+        self.timeout = timeout
+        self.sampler = ProcessSampler(pids) if pids else None
+        self.update_ids = itertools.count(random.randint(1, 10 ** 6))
+        self.lock = threading.Lock()
+
+    def next_update_id(self):
+        with self.lock:
+            return next(self.update_ids)
+
+    def build_update(self, user_id, message):
+        message.update({
+            "message_id": self.next_update_id(),
+            "from": {"id": user_id, "is_bot": False, "first_name": "load"},
+            "chat": {"id": user_id, "type": "private"},
+            "date": int(time.time()),
+        })
+        return {"update_id": self.next_update_id(), "message": message}
+
+    def post(self, update):
+        """
+        Posts an update to the bot webhook
+        Returns latency and whether the request succeeded
+        :param update: dict
+        :return: tuple
+        """
+        start = time.perf_counter()
+        try:
+            response = requests.post(self.app_url, json=update, timeout=self.timeout)
+            ok = response.status_code == 200
+        except requests.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    def wait_completion(self, user_id, since):
+        """
+        Waits until the fake api gets the last document or an error answer for a user
+        (parts of a split archive before the last one do not count)
+        Returns whether a document was sent
+        :param user_id: int
+        :param since: float
+        :return: bool
+        """
+        try:
+            response = requests.get(f"{self.api_url}/completion",
+                                    params={"chat_id": user_id, "since": since, "timeout": self.timeout},
+                                    timeout=self.timeout + 10)
+            data = response.json()
+        except (requests.RequestException, ValueError):
+            return False
+        return data["ok"] and data["result"]["kind"] == "document"
+
+    def run_session(self, user_id, scenario, samples):
+        file_id = f"{scenario.fixture}_{uuid.uuid4().hex}"
+        upload = self.build_update(user_id, {"document": {
+            "file_id": file_id,
+            "file_unique_id": file_id,
+            "file_name": scenario.file_name,
+            "file_size": 1000,
+        }})
+        reply = self.build_update(user_id, {"text": scenario.reply})
+
+        latency, ok = self.post(upload)
+        with self.lock:
+            samples.append((f"upload_{scenario.fixture}", latency, ok))
+        if not ok:
+            return
+
+        since = time.time()
+        start = time.perf_counter()
+        latency, ok = self.post(reply)
+        with self.lock:
+            samples.append((f"webhook_{scenario.name}", latency, ok))
+        if ok:
+            ok = self.wait_completion(user_id, since)
+        with self.lock:
+            samples.append((f"convert_{scenario.name}", time.perf_counter() - start, ok))
+
+    def choose_scenario(self):
+        names = list(self.mix)
+        return SCENARIOS[random.choices(names, weights=[self.mix[name] for name in names])[0]]
+
+    def run_level(self, concurrency, duration):
+        """
+        Keeps concurrency sessions running for duration seconds
+        Sessions started before the deadline are finished (their conversions are done)
+        before the api stats are read
+        :param concurrency: int
+        :param duration: float
+        :return: dict
+        """
+        samples = []
+        deadline = time.perf_counter() + duration
+        users = queue.Queue()
+        for user_id in self.users:
+            users.put(user_id)
+
+        def worker():
+            while time.perf_counter() < deadline:
+                user_id = users.get()
+                try:
+                    self.run_session(user_id, self.choose_scenario(), samples)
+                finally:
+                    users.put(user_id)
+
+        requests.post(f"{self.api_url}/stats/reset")
+        if self.sampler:
+            self.sampler.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for _ in range(concurrency):
+                executor.submit(worker)
+        elapsed = time.perf_counter() - start
+        resources = self.sampler.stop() if self.sampler else {}
+        api_stats = requests.get(f"{self.api_url}/stats").json()
+
+        return self.summarise(concurrency, elapsed, samples, api_stats, resources)
+
+    @staticmethod
+    def percentile(values, percent):
+        index = max(0, int(round(percent / 100 * len(values))) - 1)
+        return values[min(index, len(values) - 1)]
+
+    def summarise(self, concurrency, elapsed, samples, api_stats, resources):
+        by_kind = {}
+        for kind, latency, ok in samples:
+            by_kind.setdefault(kind, []).append((latency, ok))
+
+        kinds = {}
+        for kind, values in sorted(by_kind.items()):
+            latencies = sorted(latency for latency, _ in values)
+            errors = sum(1 for _, ok in values if not ok)
+            kinds[kind] = {
+                "count": len(values),
+                "p50": round(self.percentile(latencies, 50), 4),
+                "p95": round(self.percentile(latencies, 95), 4),
+                "p99": round(self.percentile(latencies, 99), 4),
+                "error_rate": round(errors / len(values), 4),
+            }
+
+        posts = [ok for kind, _, ok in samples if not kind.startswith("convert_")]
+        conversions = sum(1 for kind, _, ok in samples if kind.startswith("convert_") and ok)
+        total = len(posts)
+        replies = api_stats["messages"] or 1
+        return {
+            "concurrency": concurrency,
+            "elapsed": round(elapsed, 2),
+            "requests": total,
+            "throughput": round(total / elapsed, 2) if elapsed else 0.0,
+            "conversions": conversions,
+            "http_error_rate": round(sum(1 for ok in posts if not ok) / (total or 1), 4),
+            "bot_error_rate": round(api_stats["error_messages"] / replies, 4),
+            "documents_sent": api_stats["documents"],
+            "uploaded_mb": round(api_stats["uploaded_bytes"] / 2 ** 20, 2),
+            "resources": resources,
+            "kinds": kinds,
+        }
+
+
+def register_users(user_ids):
+    """
+    Registers virtual users in the bot database
+    Has to be run from the bot working directory
+    :param user_ids: list
+    :return: None
+    """
+    from src.database.database import DataBase, UserIsAlreadyRegistered
+
+    database = DataBase()
+    for user_id in user_ids:
+        try:
+            database.register_user(user_id)
+        except UserIsAlreadyRegistered:
+            pass
+
+
+def print_report(report):
+    resources = report["resources"]
+    print(f"\nconcurrency {report['concurrency']}: "
+          f"{report['requests']} requests in {report['elapsed']}s, "
+          f"{report['throughput']} req/s, "
+          f"{report['conversions']} conversions done, "
+          f"http errors {report['http_error_rate']:.2%}, "
+          f"bot errors {report['bot_error_rate']:.2%}, "
+          f"documents {report['documents_sent']} ({report['uploaded_mb']} MB)")
+    if resources:
+        print(f"  cpu {resources['cpu_percent']}%, peak rss {resources['peak_rss_mb']} MB")
+    print(f"  {'type':<24}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}{'errors':>9}")
+    for kind, stats in report["kinds"].items():
+        print(f"  {kind:<24}{stats['count']:>7}{stats['p50']:>10}{stats['p95']:>10}"
+              f"{stats['p99']:>10}{stats['error_rate']:>9.2%}")
+
+
+def parse_mix(value):
+    mix = {}
+    for item in value.split(","):
+        name, _, weight = item.partition(":")
+        if name not in SCENARIOS:
+            raise argparse.ArgumentTypeError(f"Unknown scenario {name}, choose from {', '.join(SCENARIOS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replays webhook updates against the bot, "
+                    "the bot has to be started with TELEGRAM_API pointed to load_test.fake_api"
+    )
+    parser.add_argument("--app-url", default="http://127.0.0.1:5000/", help="bot webhook url")
+    parser.add_argument("--api-url", default="http://127.0.0.1:8081", help="fake telegram api url")
+    parser.add_argument("--users", type=int, default=50, help="number of virtual users")
+    parser.add_argument("--first-user-id", type=int, default=10 ** 9)
+    parser.add_argument("--register", action="store_true", help="register virtual users in the bot database")
+    parser.add_argument("--concurrency", default="1,2,4,8,16", help="comma separated concurrency levels")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per concurrency level")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("image:4,document:3,video:1"),
+                        help="weighted scenarios, for example image:4,document:3,video:1")
+    parser.add_argument("--pid", type=int, action="append", default=[],
+                        help="bot process id to sample cpu and memory of (repeatable)")
+    parser.add_argument("--json", help="path to write the report as json")
+    args = parser.parse_args()
+
+    user_ids = list(range(args.first_user_id, args.first_user_id + args.users))
+    if args.register:
+        register_users(user_ids)
+
+    harness = LoadHarness(args.app_url, args.api_url, user_ids, args.mix, pids=args.pid)
+    reports = []
+    for concurrency in (int(level) for level in args.concurrency.split(",")):
+        report = harness.run_level(concurrency, args.duration)
+        print_report(report)
+        reports.append(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
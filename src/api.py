@@ -18,9 +18,10 @@ class BotResource(Resource):
         :return: dict
         """
         parser = RequestParser()
+        parser.add_argument("update_id", type=int)
         parser.add_argument("message", type=dict)
         data = parser.parse_args()
         if data["message"]:
             message = data["message"]
-            self.BOT_INSTANCE.process_message(message)
+            self.BOT_INSTANCE.process_update(data["update_id"], message)
         return {"ok": True}
@@ -1,19 +1,39 @@
+import fcntl
 import json
 import os
 import requests
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from src.logger import Logger
+from src.bot.cost_model import CostModel
+from src.bot.dispatcher import Dispatcher
+from src.bot.multipart import MultipartEncoder
+from src.bot.update_tracker import UpdateTracker
 from config import Config
-from src.converters import image_converter, video_coverter, document_converter
-from src.converters.converter import UnsupportedFormatException
+from src.converters import image_converter, video_coverter, document_converter, animation_converter
+from src.converters.converter import (
+    UnsupportedFormatException, ConversionLimitException, ConversionCancelledException
+)
+from src.converters.cancellation import CancellationToken
+from src.converters.registry import ConverterRegistry
+from src.converters.sandbox import ConversionSandbox
 from src.database.database import DataBase, UserIsAlreadyRegistered
 
 
 class Bot(Config):
     """
     Bot class used for documents, images and videos conversion
+    In LOCAL_API_MODE works with a self-hosted Bot API server,
+    files are taken from the local file system instead of being downloaded
+    Running downloads and conversions of every user have cancellation tokens,
+    they are cancelled when the user sends a new file or the /cancel command
+    Conversions are queued in a Dispatcher by their estimated time (see CostModel)
     """
-    TELEGRAM_API = "https://api.telegram.org"
+    # ioctl request to clone a file (copy on write), supported by btrfs and xfs
+    FICLONE = 0x40049409
 
     def __init__(self, lang="eng"):
         self.phrases_file = "phrases.json"
@@ -22,11 +42,31 @@ class Bot(Config):
         self.image_converter = image_converter.ImageConverter()
         self.video_converter = video_coverter.VideoConverter()
         self.document_converter = document_converter.DocumentConverter()
+        self.animation_converter = animation_converter.AnimationConverter()
+        self.registry = ConverterRegistry([
+            self.image_converter,
+            self.document_converter,
+            self.video_converter,
+            self.animation_converter
+        ])
+        self.sandbox = ConversionSandbox()
         self.database = DataBase()
+        self.update_tracker = UpdateTracker(self.database, self.BOT_TOKEN.split(":")[0])
+        self.cost_model = CostModel(self.database)
+        self.dispatcher = Dispatcher()
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
 
         self.logger = Logger("bot")
         self.logger.info("Bot started")
 
+        if self.LOCAL_API_MODE:
+            self.max_download_size = self.LOCAL_MAX_DOWNLOAD_SIZE
+            self.max_upload_size = self.LOCAL_MAX_UPLOAD_SIZE
+        else:
+            self.max_download_size = self.MAX_DOWNLOAD_SIZE
+            self.max_upload_size = self.MAX_UPLOAD_SIZE
+
         self.text_data = self.read_phrases()
         self.database.set_admin(self.ADMIN_TELEGRAM_ID)
 
@@ -81,30 +121,82 @@ class Bot(Config):
         requests.post(url=self.get_url("sendMessage"), data=data)
         self.logger.info(f"Message {log_response} sent to {context['from']['id']}")
 
-    def send_document(self, context, file_path):
+    def send_document(self, context, file_path, progress_callback=None, caption=None):
         """
         Sends document to telegram to user
+        The multipart body is streamed from disk
+        In LOCAL_API_MODE the server reads the file by its path
+        progress_callback is called with (bytes_sent, total_bytes)
         :param context: dict
         :param file_path: str
+        :param progress_callback: callable
+        :param caption: str
         :return: None
         """
-        with open(file_path, "rb") as document:
-            data = {"chat_id": context["from"]["id"]}
-            file = {"document": document}
-            requests.post(url=self.get_url(method="sendDocument"), data=data, files=file)
-            self.database.inc_stat(context["from"]["id"])
-            self.logger.info(f"Document {file_path} sent to {context['from']['id']}")
-
-    def download_document(self, file_id):
+        file_size = os.path.getsize(file_path)
+        if file_size > self.max_upload_size:
+            self.logger.warning(f"Document {file_path} of {file_size} bytes exceeds upload limit")
+            self.send_message(context, "output_too_big")
+            return
+
+        fields = {"chat_id": context["from"]["id"]}
+        if caption:
+            fields["caption"] = caption
+        if self.LOCAL_API_MODE:
+            fields["document"] = f"file://{os.path.abspath(file_path)}"
+            requests.post(url=self.get_url(method="sendDocument"), data=fields)
+        else:
+            with MultipartEncoder(fields, "document", file_path, progress_callback) as body:
+                requests.post(url=self.get_url(method="sendDocument"), data=body,
+                              headers={"Content-Type": body.content_type})
+        self.database.inc_stat(context["from"]["id"])
+        self.logger.info(f"Document {file_path} sent to {context['from']['id']}")
+
+    def link_local_file(self, source_path, temp_filepath):
+        """
+        Makes a file of the local Bot API server available at a temporary path without copying it
+        Tries a hardlink, then a reflink, then falls back to a symlink
+        The link is made at a new unique path and then moved in place,
+        a path existing from an earlier download (a link to the same file) is never opened for writing
+        :param source_path: str
+        :param temp_filepath: str
+        :return: None
+        """
+        staging_path = f"{temp_filepath}.{uuid.uuid4().hex}.link"
+        try:
+            os.link(source_path, staging_path)
+            self.logger.debug("Hardlinked %s at %s", source_path, temp_filepath)
+        except OSError as e:
+            self.logger.debug("Could not hardlink %s: %s", source_path, e)
+            try:
+                with open(source_path, "rb") as source, open(staging_path, "xb") as target:
+                    fcntl.ioctl(target.fileno(), self.FICLONE, source.fileno())
+                self.logger.debug("Reflinked %s at %s", source_path, temp_filepath)
+            except OSError as e:
+                self.logger.debug("Could not reflink %s: %s", source_path, e)
+                if os.path.lexists(staging_path):
+                    os.remove(staging_path)
+                os.symlink(os.path.abspath(source_path), staging_path)
+                self.logger.debug("Symlinked %s at %s", source_path, temp_filepath)
+        os.replace(staging_path, temp_filepath)
+        # Renaming a hardlink over another link to the same file does nothing
+        if os.path.lexists(staging_path):
+            os.remove(staging_path)
+
+    def download_document(self, file_id, token=None):
         """
         Downloads file from telegram api and stores it as a temporary file
         Returns filepath
         Firstly requests telegram api to find url to file
         Secondly downloads it to a temporary folder
+        (in LOCAL_API_MODE links the local file instead)
+        A cancelled download is stopped and its partial file is deleted
         :param file_id: str
+        :param token: CancellationToken
         :return: str
+        :raises: ConversionCancelledException
         """
-        self.logger.debug(f"Finding file with id {file_id}")
+        self.logger.debug("Finding file with id %s", file_id)
         response = requests.get(
             f"{self.TELEGRAM_API}"
             f"/bot"
@@ -114,80 +206,105 @@ class Bot(Config):
         )
 
         url_filepath = response.json()["result"]["file_path"]
+        file_format = url_filepath.split(".")[-1]
+        temp_filepath = os.path.join(self.document_converter.TEMP_FOLDER, f"{file_id}.{file_format}")
 
-        self.logger.debug(f"Downloading file {file_id} in memory")
+        if self.LOCAL_API_MODE and os.path.isabs(url_filepath):
+            self.link_local_file(url_filepath, temp_filepath)
+            return temp_filepath
+
+        self.logger.debug("Downloading file %s in memory", file_id)
         response = requests.get(f"{self.TELEGRAM_API}"
                                 f"/file"
                                 f"/bot"
                                 f"{self.BOT_TOKEN}"
                                 f"/{url_filepath}",
                                 stream=True)
-        file_format = url_filepath.split(".")[-1]
 
-        temp_filepath = os.path.join(self.document_converter.TEMP_FOLDER, f"{file_id}.{file_format}")
-        self.logger.debug(f"Saving file at {temp_filepath}")
-        with open(temp_filepath, "wb") as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        self.logger.debug(f"File saved at {temp_filepath}")
+        self.logger.debug("Saving file at %s", temp_filepath)
+        try:
+            with open(temp_filepath, "wb") as f:
+                for chunk in response.iter_content(chunk_size=8192):
+                    if token is not None:
+                        token.raise_if_cancelled()
+                    f.write(chunk)
+        except ConversionCancelledException:
+            response.close()
+            self.document_converter.delete_file(temp_filepath)
+            raise
+        self.logger.debug("File saved at %s", temp_filepath)
         return temp_filepath
 
-    def process_image(self, context, image_format):
+    def start_job(self, user_id):
         """
-        Sends message about image formats
-        :param image_format: str
-        :param context: dict
-        :return: None
+        Registers a running job of a user and returns its cancellation token
+        :param user_id: int
+        :return: CancellationToken
         """
-        available_formats = self.image_converter.AVAILABLE_FORMATS.copy()
-        available_formats.remove(image_format)
-        self.logger.debug("Document with supported image format detected")
-        self.send_message(context, "image_detected")
-        self.send_message(context,
-                          ", ".join(available_formats), is_phrase=False)
+        token = CancellationToken()
+        with self.jobs_lock:
+            self.jobs.setdefault(user_id, set()).add(token)
+        return token
 
-    def process_document(self, context, document_format):
+    def finish_job(self, user_id, token):
         """
-        Sends message about document formats
-        :param document_format: str
-        :param context: dict
+        Unregisters a finished job
+        :param user_id: int
+        :param token: CancellationToken
         :return: None
         """
-        available_formats = self.document_converter.AVAILABLE_OUTPUT_FORMATS.copy()
-        available_formats.remove(document_format)
-        self.logger.debug("Document with supported document format detected")
-        self.send_message(context, "document_detected")
-        self.send_message(context,
-                          ", ".join(available_formats), is_phrase=False)
+        with self.jobs_lock:
+            tokens = self.jobs.get(user_id)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self.jobs[user_id]
 
-    def process_video(self, context, video_format):
+    def cancel_jobs(self, user_id):
         """
-        Sends message about video formats
-        :param video_format: str
+        Cancels running jobs of a user and returns their number
+        :param user_id: int
+        :return: int
+        """
+        with self.jobs_lock:
+            tokens = self.jobs.pop(user_id, set())
+        for token in tokens:
+            token.cancel()
+        if tokens:
+            self.logger.info(f"Cancelled {len(tokens)} jobs of user {user_id}")
+        return len(tokens)
+
+    def process_detected(self, context, file_format, kind):
+        """
+        Sends message about formats a received file can be converted to
         :param context: dict
+        :param file_format: str
+        :param kind: str
         :return: None
         """
-        available_formats = self.video_converter.AVAILABLE_FORMATS.copy()
-        available_formats.remove(video_format)
-        self.logger.debug("Document with supported video format detected")
-        self.send_message(context, "video_detected")
+        self.logger.debug("Document with supported %s format detected", kind)
+        self.send_message(context, f"{kind}_detected")
         self.send_message(context,
-                          ", ".join(available_formats), is_phrase=False)
+                          ", ".join(self.registry.get_targets(file_format)), is_phrase=False)
 
-    def process_media(self, context):
+    def process_media(self, context, attachment="document", kind=None):
         """
-        Processes media if document is received
-        If a document was received firstly tries to delete the previous assigned file path
+        Processes media if document, sticker or animation is received
+        If a file was received firstly cancels running jobs of the user
+        and tries to delete the previous assigned file path
         Sets a new file path
-        Downloads the document and stores it in a temporary folder
-        Recognizes a file format and calls the corresponding answer function
+        Downloads the file and stores it in a temporary folder
+        Recognizes a file format (unless kind is supplied) and calls the corresponding answer function
         :param context: dict
+        :param attachment: str
+        :param kind: str
         :return: None
         """
-        if "document" in context:
-            self.logger.debug("Document detected")
+        if attachment in context:
+            self.logger.debug("%s detected", attachment.capitalize())
 
-            file_id = context["document"]["file_id"]
+            file_id = context[attachment]["file_id"]
+            self.cancel_jobs(context["from"]["id"])
             old_path = self.document_converter.find_file_by_id(
                 self.database.get_filepath(
                     context["from"]["id"]
@@ -203,20 +320,18 @@ class Bot(Config):
                 file_id
             )
 
-            document_path = self.download_document(file_id)
+            token = self.start_job(context["from"]["id"])
+            try:
+                document_path = self.download_document(file_id, token)
+            finally:
+                self.finish_job(context["from"]["id"], token)
             file_format = document_path.split(".")[-1]
 
-            if file_format in self.image_converter.AVAILABLE_FORMATS:
-                self.process_image(context, file_format)
-
-            elif file_format in self.document_converter.AVAILABLE_INPUT_FORMATS:
-                self.process_document(context, file_format)
-
-            elif file_format in self.video_converter.AVAILABLE_FORMATS:
-                self.process_video(context, file_format)
-
+            detected_kind = self.registry.get_kind(file_format)
+            if detected_kind:
+                self.process_detected(context, file_format, kind or detected_kind)
             else:
-                self.logger.debug(f"Document format {file_format} not supported")
+                self.logger.debug("Document format %s not supported", file_format)
                 self.send_message(context, "not_supported_format")
 
     def command_start(self, context):
@@ -227,14 +342,27 @@ class Bot(Config):
         """
         self.send_message(context, "start")
 
+    def command_cancel(self, context):
+        """
+        Cancels running downloads and conversions of a user
+        :param context: dict
+        :return: None
+        """
+        if self.cancel_jobs(context["from"]["id"]):
+            self.send_message(context, "cancelled")
+        else:
+            self.send_message(context, "nothing_to_cancel")
+
     def command_formats(self, context):
         message = f"{self.get_answer('available_formats')}\n\n" \
                   f"{self.get_answer('available_formats_images')}\n" \
-                  f"{', '.join(self.image_converter.AVAILABLE_FORMATS)}\n\n" \
+                  f"{', '.join(self.registry.input_formats['image'])}\n\n" \
                   f"{self.get_answer('available_formats_documents')}\n" \
-                  f"{', '.join(self.document_converter.AVAILABLE_INPUT_FORMATS)}\n\n" \
+                  f"{', '.join(self.registry.input_formats['document'])}\n\n" \
                   f"{self.get_answer('available_formats_video')}\n" \
-                  f"{', '.join(self.video_converter.AVAILABLE_FORMATS)}"
+                  f"{', '.join(self.registry.input_formats['video'])}\n\n" \
+                  f"{self.get_answer('available_formats_animation')}\n" \
+                  f"{', '.join(self.registry.input_formats['animation'])}"
         self.send_message(context, message, is_phrase=False)
 
     def command_register(self, context):
@@ -278,60 +406,132 @@ class Bot(Config):
             self.command_formats(context)
         elif "/register" in context["text"]:
             self.command_register(context)
+        elif "/cancel" in context["text"]:
+            self.command_cancel(context)
         else:
             self.send_message(context, "wrong_command")
 
-    def convert_image(self, context, file_id):
+    @staticmethod
+    def format_duration(seconds):
         """
-        Converts and sends received image
-        :param context: dict
-        :param file_id: str
-        :return: None
+        Formats seconds for a user
+        :param seconds: float
+        :return: str
         """
-        self.send_message(context, "converting_image")
-        file_path = self.image_converter.find_file_by_id(file_id)
-        old_format = file_path.split(".")[-1]
-        if old_format in self.image_converter.AVAILABLE_FORMATS:
-            new_file_path = self.image_converter.convert(file_path, context["text"])
-            self.send_document(context, new_file_path)
-            self.logger.debug("Image conversion successful")
-            self.image_converter.delete_file(new_file_path)
+        if seconds < 60:
+            return f"{max(1, round(seconds))} s"
+        return f"{round(seconds / 60)} min"
 
-    def convert_document(self, context, file_id):
+    def convert_file(self, context, file_id):
         """
-        Converts and sends received document
+        Queues conversion of a received file
+        Follows the conversion chain planned by the registry
+        The job is estimated by the cost model, the estimated wait is sent to the user
         :param context: dict
         :param file_id: str
         :return: None
+        :raises: UnsupportedFormatException
         """
-        self.send_message(context, "converting_document")
         file_path = self.document_converter.find_file_by_id(file_id)
-        old_format = file_path.split(".")[-1]
-        if old_format in self.document_converter.AVAILABLE_INPUT_FORMATS:
-            new_file_path = self.document_converter.convert(file_path, context["text"])
-            self.send_document(context, new_file_path)
-            self.logger.debug("Document conversion successful")
-            self.document_converter.delete_file(new_file_path)
+        if not file_path:
+            self.send_message(context, "no_file")
+            return
+        new_format = context["text"].lower()
+        steps = self.registry.plan(file_path.split(".")[-1], new_format)
+
+        size = os.path.getsize(file_path)
+        pixels = self.registry.get_pixels(file_path)
+        estimate = self.cost_model.estimate(steps, size, pixels)
+        wait = self.dispatcher.estimate_wait(estimate)
+        self.send_message(context,
+                          f"{self.get_answer(f'converting_{steps[0].kind}')}\n"
+                          f"{self.get_answer('estimated_time')} {self.format_duration(wait)}",
+                          is_phrase=False)
+
+        token = self.start_job(context["from"]["id"])
+        self.dispatcher.submit(estimate, self.run_conversion, context, file_path, new_format,
+                               steps, size, pixels, token, token=token)
+
+    def run_conversion(self, context, file_path, new_format, steps, size, pixels, token):
+        """
+        Converts and sends a file, run by the dispatcher
+        Parts of a split result are uploaded one by one while the next part is produced,
+        the last one is sent with the number of parts as a caption
+        The conversion runs in a limited worker process (see ConversionSandbox)
+        and can be cancelled (see cancel_jobs), parts are not sent after that
+        Time of a successful conversion is recorded by the cost model
+        Errors are reported to the user
+        :param context: dict
+        :param file_path: str
+        :param new_format: str
+        :param steps: tuple
+        :param size: int
+        :param pixels: int
+        :param token: CancellationToken
+        :return: None
+        """
+        user_id = context["from"]["id"]
+        try:
+            started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=1) as uploader:
+                uploads = []
+
+                def send_part(part_path, caption=None):
+                    uploads.append(uploader.submit(self.send_part, context, part_path, token, caption))
+
+                try:
+                    new_file_path = self.sandbox.run(self.registry.convert, file_path, new_format,
+                                                     on_part=send_part, token=token)
+                except ConversionCancelledException:
+                    raise
+                except Exception as e:
+                    # The input of a superseded conversion may be deleted before the worker is stopped
+                    if token.is_cancelled():
+                        raise ConversionCancelledException(f"Conversion of user {user_id} cancelled") from e
+                    raise
+                seconds = time.monotonic() - started
+                send_part(new_file_path,
+                          f"{self.get_answer('split_archive')} {len(uploads) + 1}" if uploads else None)
+                for upload in uploads:
+                    upload.result()
+            token.raise_if_cancelled()
+            self.cost_model.record(steps, size, pixels, seconds)
+            self.logger.debug("Conversion from %s to %s in %s steps successful, %s parts sent",
+                              steps[0].old_format, new_format, len(steps), len(uploads))
+
+        except UnsupportedFormatException:
+            self.send_message(context, "wrong_format")
+            self.logger.error("Wrong format")
+
+        except ConversionLimitException as e:
+            self.send_message(context, "conversion_limit")
+            self.logger.warning(f"Conversion of user {user_id} stopped: {e}")
+
+        except ConversionCancelledException as e:
+            self.logger.info(e)
+
+        except Exception as e:
+            self.send_message(context, "error")
+            self.logger.error(e)
 
-    def convert_video(self, context, file_id):
+        finally:
+            self.finish_job(user_id, token)
+
+    def send_part(self, context, file_path, token=None, caption=None):
         """
-        Converts and sends received video
+        Sends a converted file (or a part of it) and deletes it
+        A part of a cancelled conversion is only deleted
         :param context: dict
-        :param file_id: str
+        :param file_path: str
+        :param token: CancellationToken
+        :param caption: str
         :return: None
         """
-        self.send_message(context, "converting_video")
-        file_path = self.video_converter.find_file_by_id(file_id)
-        old_format = file_path.split(".")[-1]
-        if old_format in self.video_converter.AVAILABLE_FORMATS:  # TODO
-            if context["text"] == "frame":
-                new_file_path = self.video_converter.frame_video(file_path)
-                self.send_document(context, new_file_path)
-                self.logger.debug("Video conversion successful")
-                self.video_converter.delete_file(new_file_path)
-            else:
-                # TODO
-                self.send_message(context, "dev_feature")
+        try:
+            if token is None or not token.is_cancelled():
+                self.send_document(context, file_path, caption=caption)
+        finally:
+            self.document_converter.delete_file(file_path)
 
     def process_file_format(self, context):
         """
@@ -342,16 +542,8 @@ class Bot(Config):
         if self.database.get_authorised(telegram_id=context["from"]["id"]):
             prev_file_path = self.database.get_filepath(context["from"]["id"])
             if prev_file_path:
-                text = context["text"].lower()
-                if text in self.document_converter.AVAILABLE_OUTPUT_FORMATS:
-                    self.convert_document(context, prev_file_path)
-
-                elif text in self.image_converter.AVAILABLE_FORMATS:
-                    self.convert_image(context, prev_file_path)
-
-                elif text in self.video_converter.AVAILABLE_FORMATS:
-                    self.convert_video(context, prev_file_path)
-
+                if self.registry.is_output_format(context["text"].lower()):
+                    self.convert_file(context, prev_file_path)
                 else:
                     self.send_message(context, "not_supported_format")
             else:
@@ -379,6 +571,29 @@ class Bot(Config):
             self.send_message(context, "wrong_format")
             self.logger.error("Wrong format")
 
+    def process_update(self, update_id, context):
+        """
+        Processes a message of a webhook update once
+        A re-delivered update is not processed again,
+        if it is still in progress waits for it up to UPDATE_ATTACH_TIMEOUT
+        :param update_id: int
+        :param context: dict
+        :return: None
+        """
+        if update_id is None:
+            self.process_message(context)
+            return
+
+        is_new, processed = self.update_tracker.begin(update_id)
+        if not is_new:
+            self.logger.info(f"Update {update_id} is a duplicate")
+            processed.wait(self.UPDATE_ATTACH_TIMEOUT)
+            return
+        try:
+            self.process_message(context)
+        finally:
+            self.update_tracker.finish(update_id)
+
     def process_message(self, context):
         """
         Processes message send by a user in telegram
@@ -391,23 +606,20 @@ class Bot(Config):
                 self.process_text(context)
             else:
                 if self.database.get_authorised(telegram_id=context["from"]["id"]):
-                    if "document" in context:
-                        if context["document"]["file_size"] <= 2000000:
-                            self.process_media(context)
+                    # Animations also carry a document, check them first
+                    attachment = next(
+                        (key for key in ("animation", "sticker", "document") if key in context), None
+                    )
+                    if attachment:
+                        if context[attachment].get("file_size", 0) <= self.max_download_size:
+                            kind = None if attachment == "document" else self.animation_converter.KIND
+                            self.process_media(context, attachment, kind)
                         else:
                             self.send_message(context, "file_too_big")
 
                     elif "photo" in context or "video" in context:
                         self.send_message(context, "compressed_file")
 
-                    elif "sticker" in context:
-                        # TODO sticker
-                        self.send_message(context, "dev_feature")
-
-                    elif "animation" in context:
-                        # TODO animation
-                        self.send_message(context, "dev_feature")
-
                     elif "audio" in context:
                         self.send_message(context, "dev_feature")
                         # TODO audio
@@ -415,6 +627,8 @@ class Bot(Config):
                         self.send_message(context, "unsupported_message_type")
                 else:
                     self.send_message(context, "unknown_user")
+        except ConversionCancelledException:
+            self.logger.info(f"Download of user {context['from']['id']} cancelled")
         except Exception as e:
             self.send_message(context, "error")
             self.logger.error(e)
@@ -0,0 +1,114 @@
+import threading
+
+import numpy
+
+from src.logger import Logger
+from config import Config
+
+
+class CostModel(Config):
+    """
+    Estimates conversion time in seconds out of recorded timings
+    Fits seconds = a + b * megabytes + c * megapixels of an input by least squares
+    for every conversion (a chain of converters and a format pair)
+    and for every chain of converters regardless of formats, the latter is used while the former lacks samples
+    Sums are decayed by COST_MODEL_DECAY on every sample so recent timings weigh more
+    Before COST_MODEL_MIN_SAMPLES are recorded the planned cost of steps is used
+    """
+    ANY_FORMAT = "*"
+
+    def __init__(self, database):
+        self.database = database
+        self.logger = Logger("cost_model")
+        self.lock = threading.Lock()
+        self.timings = database.get_timings()
+
+    def get_keys(self, steps):
+        """
+        Returns keys of timings of a conversion chain, the most specific first
+        :param steps: tuple
+        :return: tuple
+        """
+        kind = "+".join(step.kind for step in steps)
+        return (
+            (kind, steps[0].old_format, steps[-1].new_format),
+            (kind, self.ANY_FORMAT, self.ANY_FORMAT),
+        )
+
+    @staticmethod
+    def get_sample(size, pixels, seconds):
+        """
+        Returns a timing as terms of the sums (see Timing.SUMS)
+        :param size: int
+        :param pixels: int
+        :param seconds: float
+        :return: list
+        """
+        megabytes = size / 1e6
+        megapixels = pixels / 1e6
+        return [
+            1.0, megabytes, megapixels,
+            megabytes * megabytes, megabytes * megapixels, megapixels * megapixels,
+            seconds, megabytes * seconds, megapixels * seconds,
+        ]
+
+    def fit(self, sums):
+        """
+        Solves the normal equations of the sums
+        Slopes are regularized by COST_MODEL_RIDGE so inputs of one size still give a fit
+        Returns (a, b, c) or None
+        :param sums: list
+        :return: numpy.ndarray
+        """
+        weight, size, pixels, size_size, size_pixels, pixels_pixels, seconds, size_seconds, pixels_seconds = sums
+        matrix = numpy.array([
+            [weight, size, pixels],
+            [size, size_size + self.COST_MODEL_RIDGE, size_pixels],
+            [pixels, size_pixels, pixels_pixels + self.COST_MODEL_RIDGE],
+        ])
+        try:
+            return numpy.linalg.solve(matrix, numpy.array([seconds, size_seconds, pixels_seconds]))
+        except numpy.linalg.LinAlgError:
+            return None
+
+    def estimate(self, steps, size, pixels):
+        """
+        Estimates seconds a conversion chain takes for an input
+        :param steps: tuple
+        :param size: int
+        :param pixels: int
+        :return: float
+        """
+        with self.lock:
+            timings = [self.timings.get(key) for key in self.get_keys(steps)]
+        for timing in timings:
+            if timing is None or timing[0] < self.COST_MODEL_MIN_SAMPLES:
+                continue
+            coefficients = self.fit(timing[1])
+            if coefficients is not None:
+                sample = self.get_sample(size, pixels, 0.0)
+                seconds = coefficients[0] + coefficients[1] * sample[1] + coefficients[2] * sample[2]
+                return max(float(seconds), self.COST_MODEL_MIN_SECONDS)
+        return sum(step.cost for step in steps) * self.COST_MODEL_SECONDS_PER_COST
+
+    def record(self, steps, size, pixels, seconds):
+        """
+        Records a timing of a conversion chain and stores updated sums in the database
+        :param steps: tuple
+        :param size: int
+        :param pixels: int
+        :param seconds: float
+        :return: None
+        """
+        sample = self.get_sample(size, pixels, seconds)
+        updated = []
+        with self.lock:
+            for key in self.get_keys(steps):
+                samples, sums = self.timings.get(key, (0, [0.0] * len(sample)))
+                sums = [self.COST_MODEL_DECAY * total + term for total, term in zip(sums, sample)]
+                self.timings[key] = (samples + 1, sums)
+                updated.append((key, samples + 1, sums))
+
+        for (kind, old_format, new_format), samples, sums in updated:
+            self.database.set_timing(kind, old_format, new_format, samples, sums)
+        self.logger.debug("Recorded %.2f s of %s for %s bytes, %s pixels", seconds, updated[0][0], size, pixels)
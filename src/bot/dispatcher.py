@@ -0,0 +1,105 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from collections import namedtuple
+
+from src.logger import Logger
+from config import Config
+
+
+Job = namedtuple("Job", ["number", "estimate", "function", "args", "token"])
+
+
+class Dispatcher(Config):
+    """
+    Runs conversion jobs in CONVERSION_WORKERS threads, the shortest estimated job first
+    Waiting jobs age: every second in the queue takes SCHEDULER_AGING seconds off their estimate,
+    so long jobs are not starved by a stream of short ones
+    Cancelled jobs are dropped when they come out of the queue
+    Worker threads are started on the first job in every process
+    """
+    def __init__(self, workers=None):
+        self.logger = Logger("dispatcher")
+        self.workers = workers or self.CONVERSION_WORKERS
+        self.condition = threading.Condition()
+        self.queue = []
+        self.running = {}
+        self.counter = itertools.count()
+        self.pid = None
+
+    def start(self):
+        """
+        Starts worker threads
+        :return: None
+        """
+        self.pid = os.getpid()
+        for number in range(self.workers):
+            threading.Thread(target=self.work, name=f"dispatcher-{number}", daemon=True).start()
+        self.logger.debug("Started %s dispatcher workers in process %s", self.workers, self.pid)
+
+    def get_priority(self, estimate, enqueued):
+        """
+        Returns a queue priority, waiting lowers all priorities alike so it is fixed on enqueueing
+        :param estimate: float
+        :param enqueued: float
+        :return: float
+        """
+        return estimate + self.SCHEDULER_AGING * enqueued
+
+    def estimate_wait(self, estimate):
+        """
+        Estimates seconds until a new job with the estimate would be done
+        Counts queued jobs ahead of it and the remaining time of running jobs
+        :param estimate: float
+        :return: float
+        """
+        now = time.monotonic()
+        priority = self.get_priority(estimate, now)
+        with self.condition:
+            ahead = sum(job.estimate for job_priority, _, job in self.queue if job_priority <= priority)
+            remaining = sum(max(0.0, job_estimate - (now - started))
+                            for started, job_estimate in self.running.values())
+        return (ahead + remaining) / self.workers + estimate
+
+    def submit(self, estimate, function, *args, token=None):
+        """
+        Queues function(*args), exceptions of the function are only logged
+        :param estimate: float
+        :param function: callable
+        :param args: tuple
+        :param token: CancellationToken
+        :return: None
+        """
+        job = Job(next(self.counter), estimate, function, args, token)
+        with self.condition:
+            if self.pid != os.getpid():
+                self.queue = []
+                self.running = {}
+                self.start()
+            heapq.heappush(self.queue, (self.get_priority(estimate, time.monotonic()), job.number, job))
+            self.condition.notify()
+        self.logger.debug("Job %s queued, estimated %.1f s, %s in queue", job.number, estimate, len(self.queue))
+
+    def work(self):
+        """
+        Worker thread body
+        :return: None
+        """
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                _, _, job = heapq.heappop(self.queue)
+                if job.token is not None and job.token.is_cancelled():
+                    self.logger.debug("Job %s cancelled in queue", job.number)
+                    continue
+                self.running[job.number] = (time.monotonic(), job.estimate)
+            try:
+                job.function(*job.args)
+            except Exception as e:
+                self.logger.error(f"Job {job.number} failed: {e}")
+            finally:
+                with self.condition:
+                    self.running.pop(job.number, None)
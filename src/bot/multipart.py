@@ -0,0 +1,85 @@
+import os
+import uuid
+
+
+class MultipartEncoder:
+    """
+    multipart/form-data body which streams a file from disk in chunks
+    Can be passed to requests as data, memory use does not depend on the file size
+    progress_callback is called with (bytes_sent, total_bytes) after every chunk
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, fields, file_field, file_path, progress_callback=None):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.progress_callback = progress_callback
+
+        file_name = os.path.basename(file_path).replace('"', "%22")
+        head = b"".join(self.encode_field(name, value) for name, value in fields.items())
+        head += (
+            f"--{self.boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"{file_field}\"; filename=\"{file_name}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n"
+        ).encode("utf-8")
+        tail = f"\r\n--{self.boundary}--\r\n".encode("utf-8")
+
+        self.file = open(file_path, "rb")
+        self.file_size = os.fstat(self.file.fileno()).st_size
+        self.head = head
+        self.tail = tail
+        self.total = len(head) + self.file_size + len(tail)
+        self.sent = 0
+
+    def encode_field(self, name, value):
+        return (
+            f"--{self.boundary}\r\n"
+            f"Content-Disposition: form-data; name=\"{name}\"\r\n\r\n"
+            f"{value}\r\n"
+        ).encode("utf-8")
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def read(self, size=-1):
+        """
+        Reads the next part of the body
+        Never returns more than CHUNK_SIZE bytes of the file at once
+        :param size: int
+        :return: bytes
+        """
+        if size is None or size < 0:
+            size = self.CHUNK_SIZE
+        head_end = len(self.head)
+        file_end = head_end + self.file_size
+
+        if self.sent < head_end:
+            chunk = self.head[self.sent:self.sent + size]
+        elif self.sent < file_end:
+            chunk = self.file.read(min(size, self.CHUNK_SIZE, file_end - self.sent))
+            if not chunk:
+                raise IOError(f"{self.file.name} was truncated while uploading")
+        else:
+            offset = self.sent - file_end
+            chunk = self.tail[offset:offset + size]
+
+        self.sent += len(chunk)
+        if chunk and self.progress_callback:
+            self.progress_callback(self.sent, self.total)
+        return chunk
+
+    def close(self):
+        self.file.close()
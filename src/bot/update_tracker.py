@@ -0,0 +1,75 @@
+import datetime
+import threading
+from collections import OrderedDict
+
+from src.logger import Logger
+from config import Config
+
+
+class UpdateTracker(Config):
+    """
+    Deduplicates telegram updates re-delivered by webhook retries
+    Keeps a bounded in-memory record of recent update ids (UPDATE_CACHE_SIZE)
+    backed by the database so duplicates are found across worker processes and restarts
+    Every recorded update has an event which is set when it is processed,
+    retries of an update in progress can wait for it instead of starting new work
+    """
+    def __init__(self, database, bot_id):
+        self.database = database
+        self.bot_id = bot_id
+        self.logger = Logger("updates")
+        self.lock = threading.Lock()
+        self.updates = OrderedDict()
+        self.recorded = 0
+
+    def begin(self, update_id):
+        """
+        Records an update
+        Returns whether the update is new and an event set when it is processed
+        If the update can not be recorded it is forgotten and the error is raised
+        :param update_id: int
+        :return: tuple
+        """
+        with self.lock:
+            event = self.updates.get(update_id)
+            if event is not None:
+                self.updates.move_to_end(update_id)
+                return False, event
+
+            event = threading.Event()
+            self.updates[update_id] = event
+            if len(self.updates) > self.UPDATE_CACHE_SIZE:
+                self.updates.popitem(last=False)
+
+        try:
+            is_new = self.database.begin_update(
+                self.bot_id, update_id, datetime.timedelta(seconds=self.UPDATE_STALE_SECONDS)
+            )
+        except Exception:
+            # Forget the update so a retry of the webhook is processed
+            with self.lock:
+                if self.updates.get(update_id) is event:
+                    del self.updates[update_id]
+            event.set()
+            raise
+        if not is_new:
+            # Recorded by another process or before a restart
+            event.set()
+            return False, event
+
+        self.recorded += 1
+        if self.recorded % self.UPDATE_PRUNE_INTERVAL == 0:
+            self.database.prune_updates(datetime.timedelta(hours=self.UPDATE_HISTORY_HOURS))
+        return True, event
+
+    def finish(self, update_id):
+        """
+        Marks an update as processed and releases waiting retries
+        :param update_id: int
+        :return: None
+        """
+        with self.lock:
+            event = self.updates.get(update_id)
+        if event is not None:
+            event.set()
+        self.database.finish_update(self.bot_id, update_id)
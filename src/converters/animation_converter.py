@@ -0,0 +1,389 @@
+import io
+import struct
+import zlib
+
+import cv2
+import numpy
+from PIL import Image, ImageSequence, GifImagePlugin, UnidentifiedImageError
+
+from src.converters.converter import *
+
+
+class AnimationConverter(Converter):
+    """
+    Animation Converter class used for telegram animations (mp4) and stickers (webp)
+    Converts them to and from gif, animated png (apng) and mp4
+    and takes the first frame as a png (SNAPSHOT_FORMATS) which image formats are converted from
+    Frames are decoded one by one, capped by ANIMATION_MAX_FPS, ANIMATION_MAX_SIZE
+    and ANIMATION_MAX_FRAMES and encoded as they come
+    Gif frames share one palette computed from a sample of frames
+    Frame delays are rounded to the units of a format (GIF_DELAY_UNIT, APNG_DELAY_UNIT),
+    the rounding error is carried to the next frame so the animation keeps its speed
+    """
+    LOGGER_NAME = "anim_conv"
+    KIND = "animation"
+    CONVERSION_COST = 5.0
+    AVAILABLE_INPUT_FORMATS = ["mp4", "gif", "webp"]
+    # Costlier than snapshots of the video converter, so mp4 -> png still takes the middle frame
+    SNAPSHOT_COST = 4.0
+    SNAPSHOT_FORMATS = ["png"]
+    AVAILABLE_OUTPUT_FORMATS = ["gif", "apng", "mp4"] + SNAPSHOT_FORMATS
+    FILE_FORMATS = {"apng": "png"}
+    VIDEO_FORMATS = ["mp4"]
+    PALETTE_SAMPLES = 16
+    PALETTE_SAMPLE_STRIDE = 4
+    GIF_LOOP_EXTENSION = b"!\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00"
+    # Milliseconds
+    GIF_DELAY_UNIT = 10
+    APNG_DELAY_UNIT = 1
+    PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+    def estimate_cost(self, old_format, new_format):
+        if new_format in self.SNAPSHOT_FORMATS:
+            return self.SNAPSHOT_COST
+        return self.CONVERSION_COST
+
+    def convert(self, animation_path, new_format, on_part=None, token=None):
+        """
+        Converts an animation to a specified format
+        Returns filepath of a new file
+        :param animation_path: str
+        :param new_format: str
+        :param on_part: callable (not used, the result is a single file)
+        :param token: CancellationToken
+        :return: str
+        :raises: UnsupportedFormatException
+        """
+        self.logger.debug("Converting animation at %s to %s", animation_path, new_format)
+
+        old_format = animation_path.split(".")[-1]
+        if new_format not in self.AVAILABLE_OUTPUT_FORMATS:
+            error_message = f"Format {new_format} is not supported to convert to"
+            self.logger.error(error_message)
+            raise UnsupportedFormatException(error_message)
+        if old_format not in self.AVAILABLE_INPUT_FORMATS:
+            error_message = f"Format {old_format} is not supported to convert from"
+            self.logger.error(error_message)
+            raise UnsupportedFormatException(error_message)
+
+        try:
+            fps, frames = self.read_frames(animation_path, token)
+            new_file_path = self.generate_temp_path(self.FILE_FORMATS.get(new_format, new_format))
+        except UnidentifiedImageError:
+            raise UnsupportedFormatException(f"Could not read animation at {animation_path}")
+
+        try:
+            if new_format == "gif":
+                palette = self.create_palette(animation_path)
+                count = self.write_gif(new_file_path, frames, fps, palette)
+            elif new_format == "apng":
+                count = self.write_apng(new_file_path, frames, fps)
+            elif new_format in self.SNAPSHOT_FORMATS:
+                count = self.write_snapshot(new_file_path, frames)
+            else:
+                count = self.write_video(new_file_path, frames, fps)
+        except Exception as e:
+            if os.path.exists(new_file_path):
+                self.delete_file(new_file_path)
+            if isinstance(e, UnidentifiedImageError):
+                raise UnsupportedFormatException(f"Could not read animation at {animation_path}")
+            raise
+
+        if not count:
+            if os.path.exists(new_file_path):
+                self.delete_file(new_file_path)
+            raise UnsupportedFormatException(f"No frames read from {animation_path}")
+        self.logger.info(f"Converted animation {animation_path} to {new_file_path} ({count} frames)")
+        return new_file_path
+
+    def get_pixels(self, animation_path):
+        if animation_path.split(".")[-1] in self.VIDEO_FORMATS:
+            video = cv2.VideoCapture(animation_path)
+            pixels = int(video.get(cv2.CAP_PROP_FRAME_WIDTH)) * int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)) \
+                * min(int(video.get(cv2.CAP_PROP_FRAME_COUNT)), self.ANIMATION_MAX_FRAMES)
+            video.release()
+            return max(pixels, 0)
+        with Image.open(animation_path) as image:
+            return image.width * image.height * min(getattr(image, "n_frames", 1), self.ANIMATION_MAX_FRAMES)
+
+    def read_frames(self, animation_path, token=None):
+        """
+        Returns an output frame rate and a generator of capped RGB frames
+        :param animation_path: str
+        :param token: CancellationToken
+        :return: tuple
+        """
+        if animation_path.split(".")[-1] in self.VIDEO_FORMATS:
+            video = cv2.VideoCapture(animation_path)
+            source_fps = video.get(cv2.CAP_PROP_FPS) or self.ANIMATION_MAX_FPS
+            video.release()
+            frames = self.read_video_frames(animation_path, source_fps)
+        else:
+            with Image.open(animation_path) as image:
+                if image.width * image.height > self.IMAGE_MAX_PIXELS:
+                    raise ConversionLimitException(f"Animation {animation_path} is too big")
+                # Webp frame durations are only read when a frame is loaded
+                image.load()
+                source_fps = 1000 / (image.info.get("duration") or 100)
+            frames = self.read_image_frames(animation_path)
+
+        fps = min(source_fps, self.ANIMATION_MAX_FPS)
+        return fps, self.limit_frames(frames, fps, token)
+
+    @staticmethod
+    def read_video_frames(video_path, fps):
+        """
+        Yields (timestamp, RGB frame) of a video
+        :param video_path: str
+        :param fps: float
+        :return: generator
+        """
+        video = cv2.VideoCapture(video_path)
+        index = 0
+        try:
+            while True:
+                success, image = video.read()
+                if not success:
+                    return
+                yield index / fps, cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                index += 1
+        finally:
+            video.release()
+
+    @staticmethod
+    def flatten(frame):
+        """
+        Returns an RGB copy of a frame, transparent areas become white
+        :param frame: Image
+        :return: Image
+        """
+        if frame.mode in ("RGBA", "LA", "P") and ("transparency" in frame.info or frame.mode != "P"):
+            background = Image.new("RGBA", frame.size, (255, 255, 255, 255))
+            background.alpha_composite(frame.convert("RGBA"))
+            return background.convert("RGB")
+        return frame.convert("RGB")
+
+    def read_image_frames(self, image_path):
+        """
+        Yields (timestamp, RGB frame) of an animated image
+        :param image_path: str
+        :return: generator
+        """
+        with Image.open(image_path) as image:
+            timestamp = 0.0
+            for frame in ImageSequence.Iterator(image):
+                yield timestamp, numpy.asarray(self.flatten(frame))
+                timestamp += (frame.info.get("duration") or 100) / 1000
+
+    def limit_frames(self, frames, fps, token=None):
+        """
+        Resamples frames to a constant frame rate, downscales them to ANIMATION_MAX_SIZE
+        and stops after ANIMATION_MAX_FRAMES
+        :param frames: generator
+        :param fps: float
+        :param token: CancellationToken
+        :return: generator
+        """
+        next_timestamp = 0.0
+        count = 0
+        size = None
+        for timestamp, frame in frames:
+            self.check_cancelled(token)
+            # Delays of a source are rounded to its format units, a frame a bit early still counts
+            if timestamp + 0.25 / fps < next_timestamp:
+                continue
+            if size is None:
+                height, width = frame.shape[:2]
+                scale = min(1.0, self.ANIMATION_MAX_SIZE / max(width, height))
+                size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            if size != (frame.shape[1], frame.shape[0]):
+                frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+            yield frame
+            count += 1
+            if count >= self.ANIMATION_MAX_FRAMES:
+                return
+            next_timestamp += 1 / fps
+
+    def sample_frames(self, animation_path):
+        """
+        Returns up to PALETTE_SAMPLES evenly spaced RGB frames
+        :param animation_path: str
+        :return: list
+        """
+        samples = []
+        if animation_path.split(".")[-1] in self.VIDEO_FORMATS:
+            video = cv2.VideoCapture(animation_path)
+            total = max(1, int(video.get(cv2.CAP_PROP_FRAME_COUNT)))
+            for index in sorted({total * sample // self.PALETTE_SAMPLES for sample in range(self.PALETTE_SAMPLES)}):
+                video.set(cv2.CAP_PROP_POS_FRAMES, index)
+                success, image = video.read()
+                if success:
+                    samples.append(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+            video.release()
+        else:
+            with Image.open(animation_path) as image:
+                total = getattr(image, "n_frames", 1)
+                for index in sorted({total * sample // self.PALETTE_SAMPLES for sample in range(self.PALETTE_SAMPLES)}):
+                    image.seek(index)
+                    samples.append(numpy.asarray(self.flatten(image)))
+        return samples
+
+    def create_palette(self, animation_path):
+        """
+        Computes one 256 color palette from pixels of sampled frames
+        :param animation_path: str
+        :return: Image
+        """
+        stride = self.PALETTE_SAMPLE_STRIDE
+        pixels = numpy.concatenate([
+            sample[::stride, ::stride].reshape(-1, 3) for sample in self.sample_frames(animation_path)
+        ])
+        strip = Image.fromarray(numpy.ascontiguousarray(pixels.reshape(-1, 1, 3)), "RGB")
+        return strip.quantize(colors=256, method=Image.FASTOCTREE)
+
+    @staticmethod
+    def get_delays(fps, unit):
+        """
+        Yields frame delays in milliseconds rounded to a unit
+        The rounding error is carried over, so delays add up to the time of the frames
+        :param fps: float
+        :param unit: int
+        :return: generator
+        """
+        elapsed = 0.0
+        written = 0
+        while True:
+            elapsed += 1000 / fps
+            delay = max(unit, round((elapsed - written) / unit) * unit)
+            written += delay
+            yield delay
+
+    def write_gif(self, file_path, frames, fps, palette):
+        """
+        Writes frames to a gif one at a time using a shared global palette
+        :param file_path: str
+        :param frames: generator
+        :param fps: float
+        :param palette: Image
+        :return: int
+        """
+        delays = self.get_delays(fps, self.GIF_DELAY_UNIT)
+        count = 0
+        with open(file_path, "wb") as f:
+            for frame in frames:
+                image = Image.fromarray(frame, "RGB").quantize(palette=palette, dither=0)
+                delay = next(delays)
+                if not count:
+                    header, _ = GifImagePlugin.getheader(image, info={"duration": delay})
+                    f.write(b"".join(header))
+                    f.write(self.GIF_LOOP_EXTENSION)
+                f.write(b"".join(GifImagePlugin.getdata(image, duration=delay, disposal=1)))
+                count += 1
+            f.write(b";")
+        return count
+
+    @staticmethod
+    def write_chunk(f, chunk_type, data):
+        """
+        Writes a png chunk
+        :param f: file
+        :param chunk_type: bytes
+        :param data: bytes
+        :return: None
+        """
+        f.write(struct.pack(">I", len(data)))
+        f.write(chunk_type)
+        f.write(data)
+        f.write(struct.pack(">I", zlib.crc32(chunk_type + data)))
+
+    def encode_png(self, frame):
+        """
+        Encodes a frame as a png and returns its IHDR data and joined IDAT data
+        :param frame: numpy.ndarray
+        :return: tuple
+        """
+        buffer = io.BytesIO()
+        Image.fromarray(frame, "RGB").save(buffer, format="PNG")
+        data = buffer.getvalue()
+        position = len(self.PNG_SIGNATURE)
+        header = None
+        image_data = []
+        while position < len(data):
+            length, chunk_type = struct.unpack(">I4s", data[position:position + 8])
+            chunk_data = data[position + 8:position + 8 + length]
+            if chunk_type == b"IHDR":
+                header = chunk_data
+            elif chunk_type == b"IDAT":
+                image_data.append(chunk_data)
+            position += 12 + length
+        return header, b"".join(image_data)
+
+    def write_apng(self, file_path, frames, fps):
+        """
+        Writes frames to an animated png one at a time
+        Every frame is encoded by Pillow, its image data is written as an APNG frame (fcTL and fdAT chunks)
+        The frame count in acTL is filled in at the end
+        :param file_path: str
+        :param frames: generator
+        :param fps: float
+        :return: int
+        """
+        delays = self.get_delays(fps, self.APNG_DELAY_UNIT)
+        count = 0
+        sequence = 0
+        with open(file_path, "wb") as f:
+            for frame in frames:
+                header, image_data = self.encode_png(frame)
+                if not count:
+                    f.write(self.PNG_SIGNATURE)
+                    self.write_chunk(f, b"IHDR", header)
+                    animation_control = f.tell()
+                    self.write_chunk(f, b"acTL", struct.pack(">II", 0, 0))
+                width, height = struct.unpack(">II", header[:8])
+                self.write_chunk(f, b"fcTL", struct.pack(">IIIIIHHBB", sequence, width, height, 0, 0,
+                                                         next(delays), 1000, 0, 0))
+                sequence += 1
+                if not count:
+                    self.write_chunk(f, b"IDAT", image_data)
+                else:
+                    self.write_chunk(f, b"fdAT", struct.pack(">I", sequence) + image_data)
+                    sequence += 1
+                count += 1
+            if not count:
+                return 0
+            self.write_chunk(f, b"IEND", b"")
+            f.seek(animation_control)
+            self.write_chunk(f, b"acTL", struct.pack(">II", count, 0))
+        return count
+
+    def write_snapshot(self, file_path, frames):
+        """
+        Writes the first frame to a png
+        :param file_path: str
+        :param frames: generator
+        :return: int
+        """
+        for frame in frames:
+            Image.fromarray(frame, "RGB").save(file_path, format="PNG")
+            return 1
+        return 0
+
+    def write_video(self, file_path, frames, fps):
+        """
+        Writes frames to an mp4 video
+        :param file_path: str
+        :param frames: generator
+        :param fps: float
+        :return: int
+        """
+        writer = None
+        count = 0
+        for frame in frames:
+            if writer is None:
+                height, width = frame.shape[:2]
+                writer = cv2.VideoWriter(file_path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (width, height))
+            writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+            count += 1
+        if writer is not None:
+            writer.release()
+        return count
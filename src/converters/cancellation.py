@@ -0,0 +1,36 @@
+import multiprocessing
+
+from src.converters.converter import ConversionCancelledException
+
+
+class CancellationToken:
+    """
+    Cooperative cancellation flag of a conversion job
+    Shared with forked conversion workers, so a job can be cancelled from the bot process
+    Long loops call raise_if_cancelled
+    """
+    CONTEXT = multiprocessing.get_context("fork")
+
+    def __init__(self):
+        self.event = self.CONTEXT.Event()
+
+    def cancel(self):
+        """
+        Requests the job to stop
+        :return: None
+        """
+        self.event.set()
+
+    def is_cancelled(self):
+        """
+        :return: bool
+        """
+        return self.event.is_set()
+
+    def raise_if_cancelled(self):
+        """
+        :return: None
+        :raises: ConversionCancelledException
+        """
+        if self.event.is_set():
+            raise ConversionCancelledException("Conversion cancelled")
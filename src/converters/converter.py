@@ -17,17 +17,134 @@ class UnsupportedFormatException(ImageConversionException):
     pass
 
 
+class ConversionLimitException(ImageConversionException):
+    pass
+
+
+class ConversionCancelledException(ImageConversionException):
+    pass
+
+
 class Converter(Config):
     """
     Base Converter class
+    Subclasses describe what they can do with AVAILABLE_INPUT_FORMATS,
+    AVAILABLE_OUTPUT_FORMATS and estimate_cost, ConverterRegistry builds routing from it
+    A chain can only continue with a converter from the kinds in its CHAIN_FROM_KINDS
     """
+    LOGGER_NAME = "conv"
+    KIND = ""
+    CONVERSION_COST = 1.0
+    AVAILABLE_INPUT_FORMATS = []
+    AVAILABLE_OUTPUT_FORMATS = []
+    # Kinds of converters whose results this converter takes in a chain
+    CHAIN_FROM_KINDS = ()
+    # Room left for the multipart envelope of an upload
+    PART_SIZE_MARGIN = 64 * 1024
+    # Called with every temporary path created in the process, set in conversion workers
+    _temp_callback = None
+
     def __init__(self):
-        self.logger = Logger("conv")
+        self.logger = Logger(self.LOGGER_NAME)
         self.temp_folder = os.path.join(self.BASE_DIR, self.TEMP_FOLDER)
+        upload_size = self.LOCAL_MAX_UPLOAD_SIZE if self.LOCAL_API_MODE else self.MAX_UPLOAD_SIZE
+        self.part_size = upload_size - self.PART_SIZE_MARGIN
         if not os.path.exists(self.temp_folder):
             os.makedirs(self.temp_folder)
             self.logger.info(f"Created temp folder at {self.temp_folder}")
 
+    def get_input_formats(self):
+        """
+        Formats the converter accepts
+        :return: list
+        """
+        return self.AVAILABLE_INPUT_FORMATS
+
+    def get_output_formats(self):
+        """
+        Formats the converter produces
+        :return: list
+        """
+        return self.AVAILABLE_OUTPUT_FORMATS
+
+    def estimate_cost(self, old_format, new_format):
+        """
+        Relative cost of a direct conversion used to plan conversion chains
+        :param old_format: str
+        :param new_format: str
+        :return: float
+        """
+        return self.CONVERSION_COST
+
+    def get_conversions(self):
+        """
+        Lists every direct conversion as (old_format, new_format, cost)
+        :return: list
+        """
+        return [
+            (old_format, new_format, self.estimate_cost(old_format, new_format))
+            for old_format in self.get_input_formats()
+            for new_format in self.get_output_formats()
+            if old_format != new_format
+        ]
+
+    def convert(self, file_path, new_format, on_part=None, token=None):
+        """
+        Converts a file to a specified format and returns a path of a new file
+        Converters producing archives can split them in parts of at most part_size bytes,
+        every part but the last one is handed to on_part as soon as it is finished
+        Long running converters check the cancellation token
+        :param file_path: str
+        :param new_format: str
+        :param on_part: callable
+        :param token: CancellationToken
+        :return: str
+        :raises: UnsupportedFormatException
+        :raises: ConversionCancelledException
+        """
+        raise NotImplementedError
+
+    def get_pixels(self, file_path):
+        """
+        Returns a number of pixels a conversion of a file has to process (0 if not applicable)
+        Used as a size measure by the cost model, should only read file headers
+        :param file_path: str
+        :return: int
+        """
+        return 0
+
+    @staticmethod
+    def check_cancelled(token):
+        """
+        Raises if a job is cancelled, does nothing without a token
+        :param token: CancellationToken
+        :return: None
+        :raises: ConversionCancelledException
+        """
+        if token is not None:
+            token.raise_if_cancelled()
+
+    @staticmethod
+    def set_temp_callback(callback):
+        """
+        Sets a function called with every temporary path converters of the process create
+        Files named path.* are counted as belonging to the path
+        :param callback: callable
+        :return: None
+        """
+        Converter._temp_callback = callback
+
+    @staticmethod
+    def register_temp_path(path):
+        """
+        Reports a temporary path to the temp callback
+        :param path: str
+        :return: str
+        """
+        if Converter._temp_callback is not None:
+            Converter._temp_callback(path)
+        return path
+
     def generate_temp_path(self, file_format=""):
         """
         Creates a temporary filename and returns it's full path
@@ -41,8 +158,8 @@ class Converter(Config):
         )
         if file_format:
             file_name += f".{file_format}"
-        self.logger.debug(f"Created filename at {file_name}")
-        return file_name
+        self.logger.debug("Created filename at %s", file_name)
+        return self.register_temp_path(file_name)
 
     def generate_temp_folder(self):
         """
@@ -50,9 +167,9 @@ class Converter(Config):
         :return: str
         """
         folder_name = str(time.time()).replace(".", "")
-        folder_path = os.path.join(self.temp_folder, folder_name)
+        folder_path = self.register_temp_path(os.path.join(self.temp_folder, folder_name))
         os.makedirs(folder_path)
-        self.logger.debug(f"Created nested temp folder at {folder_path}")
+        self.logger.debug("Created nested temp folder at %s", folder_path)
         return folder_path
 
     def delete_file(self, file_path):
@@ -63,7 +180,7 @@ class Converter(Config):
         """
         try:
             os.remove(file_path)
-            self.logger.debug(f"Deleted file at {file_path}")
+            self.logger.debug("Deleted file at %s", file_path)
         except PermissionError:
             self.logger.error(f"Error deleting file {file_path}")
 
@@ -73,5 +190,5 @@ class Converter(Config):
         for file in files:
             if file_id in file:
                 filepath = os.path.join(temp_folder, file)
-                self.logger.debug(f"File with id {file_id} found at {filepath}")
+                self.logger.debug("File with id %s found at %s", file_id, filepath)
                 return filepath
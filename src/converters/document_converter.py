@@ -1,7 +1,6 @@
 import pypandoc
 
 from src.converters.converter import *
-from src.logger import Logger
 
 
 class DocumentConverter(Converter):
@@ -11,6 +10,11 @@ class DocumentConverter(Converter):
     to output (AVAILABLE_OUTPUT_FORMATS) file formats
     Depends on a latex engine (Requires TeXlive)
     """
+    LOGGER_NAME = "doc_conv"
+    KIND = "document"
+    CONVERSION_COST = 2.0
+    # pdf is rendered through a latex engine
+    OUTPUT_FORMAT_COSTS = {"pdf": 20.0}
     AVAILABLE_INPUT_FORMATS = [
         'bibtex', 'biblatex', 'commonmark', 'commonmark_x', 'creole', 'csljson', 'csv', 'docbook', 'docx', 'dokuwiki',
         'epub', 'fb2', 'gfm', 'haddock', 'html', 'ipynb', 'jats', 'jira', 'json', 'latex', 'markdown', 'markdown_mmd',
@@ -25,21 +29,22 @@ class DocumentConverter(Converter):
         'opml', 'opendocument', 'org', 'pdf', 'plain', 'pptx', 'rst', 'rtf', 'texinfo', 'textile', 'slideous', 'slidy',
         'dzslides', 'revealjs', 's5', 'tei', 'xwiki', 'zimwiki']
 
-    def __init__(self):
-        super().__init__()
-        self.logger = Logger("doc_conv")
+    def estimate_cost(self, old_format, new_format):
+        return self.OUTPUT_FORMAT_COSTS.get(new_format, self.CONVERSION_COST)
 
-    def convert(self, document_path, new_format):
+    def convert(self, document_path, new_format, on_part=None, token=None):
         """
         Converts document to a specified format
         In process creates a temporary file (unavoidable using pypandoc)
         Returns filepath of temporary file
         :param document_path: str
         :param new_format: str
+        :param on_part: callable (not used, the result is a single file)
+        :param token: CancellationToken (a running pandoc is stopped by ConversionSandbox)
         :return: str
         :raises: UnsupportedFormatException
         """
-        self.logger.debug(f"Converting document from at {document_path} to {new_format}")
+        self.logger.debug("Converting document from at %s to %s", document_path, new_format)
 
         if new_format not in self.AVAILABLE_OUTPUT_FORMATS:
             error_message = f"Format {new_format} is not supported to convert to"
@@ -51,7 +56,8 @@ class DocumentConverter(Converter):
             self.logger.error(error_message)
             raise UnsupportedFormatException(error_message)
 
-        new_file_path = document_path.replace(old_format, new_format)
+        new_file_path = self.register_temp_path(document_path.replace(old_format, new_format))
+        self.check_cancelled(token)
 
         try:
 
@@ -2,45 +2,66 @@ from PIL import Image
 from PIL import UnidentifiedImageError
 
 from src.converters.converter import *
-from src.logger import Logger
 
 
 class ImageConverter(Converter):
     """
     Image Converter class used for converting images in defined formats (AVAILABLE_FORMATS)
     """
+    LOGGER_NAME = "img_conv"
+    KIND = "image"
+    # Snapshots of videos and frames of animations can be converted further
+    CHAIN_FROM_KINDS = ("video", "animation")
     AVAILABLE_FORMATS = ["ico", "bmp", "jpeg", "png", "jpg", "webp"]
+    # Pillow names of formats differing from the file extension
+    SAVE_FORMATS = {"jpg": "jpeg"}
+    # Formats keeping transparency, the rest is saved as RGB
+    ALPHA_FORMATS = ["ico", "png", "webp"]
 
-    def __init__(self):
-        super().__init__()
-        self.logger = Logger("img_conv")
+    def get_input_formats(self):
+        return self.AVAILABLE_FORMATS
 
-    def convert(self, image_path, new_format):
+    def get_output_formats(self):
+        return self.AVAILABLE_FORMATS
+
+    def get_pixels(self, image_path):
+        with Image.open(image_path) as image:
+            return image.width * image.height
+
+    def convert(self, image_path, new_format, on_part=None, token=None):
         """
         Converts an image from image path to a specified format
         Creates temporary file in doing so
-        Returns byte array
+        Returns filepath of a new file
         :param image_path: str
         :param new_format: str
-        :return: bytes
+        :param on_part: callable (not used, the result is a single file)
+        :param token: CancellationToken
+        :return: str
         :raises: UnsupportedFormatException
         :raises: SameFormatConversionException
+        :raises: ConversionLimitException
         """
-        self.logger.debug(f"Converting image to {new_format}")
+        self.logger.debug("Converting image to %s", new_format)
 
         if new_format not in self.AVAILABLE_FORMATS:
             self.logger.error(f"Format {new_format} is the same")
             raise UnsupportedFormatException
         try:
             with Image.open(image_path) as image:
+                if image.width * image.height > self.IMAGE_MAX_PIXELS:
+                    error_message = f"Image {image_path} of {image.width}x{image.height} is too big"
+                    self.logger.error(error_message)
+                    raise ConversionLimitException(error_message)
                 if image.format == new_format:
                     self.logger.error(f"Format {new_format} is the same")
                     raise UnsupportedFormatException
 
-                image.convert("RGB")
+                self.check_cancelled(token)
+                has_alpha = "A" in image.getbands() or "transparency" in image.info
+                mode = "RGBA" if has_alpha and new_format in self.ALPHA_FORMATS else "RGB"
                 new_image_path = self.generate_temp_path(new_format)
-                image.save(new_image_path, format=new_format)
-                image.close()
+                image.convert(mode).save(new_image_path, format=self.SAVE_FORMATS.get(new_format, new_format))
                 self.logger.info(f"Converted image from {image.format} to {new_format}")
                 return new_image_path
 
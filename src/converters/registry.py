@@ -0,0 +1,202 @@
+import heapq
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from src.converters.converter import UnsupportedFormatException
+from src.logger import Logger
+from config import Config
+
+
+ConversionStep = namedtuple("ConversionStep", ["kind", "old_format", "new_format", "cost"])
+
+
+class ConverterRegistry(Config):
+    """
+    Registry of converters used to route files by format
+    Builds frozen lookup tables and a conversion graph out of converter capabilities
+    Plans chains of conversions with the cheapest estimated cost (for example mp4 -> png -> webp)
+    A step of another kind of converter is only planned if that converter lists
+    the kind of the previous step in CHAIN_FROM_KINDS
+    Plans are computed once per input format and cached
+    """
+    def __init__(self, converters):
+        self.logger = Logger("registry")
+        self.converters = MappingProxyType({converter.KIND: converter for converter in converters})
+        self.chain_from = MappingProxyType({
+            converter.KIND: frozenset(converter.CHAIN_FROM_KINDS) for converter in converters
+        })
+
+        kinds = {}
+        input_formats = {}
+        output_formats = {}
+        graph = {}
+        order = {}
+        for converter in converters:
+            input_formats[converter.KIND] = tuple(converter.get_input_formats())
+            output_formats[converter.KIND] = tuple(converter.get_output_formats())
+            for file_format in input_formats[converter.KIND]:
+                kinds.setdefault(file_format, converter.KIND)
+            for old_format, new_format, cost in converter.get_conversions():
+                # The cheapest edge per converter kind, kinds decide which steps can follow
+                edges = graph.setdefault(old_format, {})
+                order.setdefault(new_format, len(order))
+                edge = (new_format, converter.KIND)
+                if edge not in edges or cost < edges[edge].cost:
+                    edges[edge] = ConversionStep(converter.KIND, old_format, new_format, cost)
+
+        self.kinds = MappingProxyType(kinds)
+        self.input_formats = MappingProxyType(input_formats)
+        self.output_formats = MappingProxyType(output_formats)
+        self.all_output_formats = frozenset(order)
+        self.graph = MappingProxyType({
+            old_format: tuple(edges.values()) for old_format, edges in graph.items()
+        })
+        self.order = MappingProxyType(order)
+
+        self._lock = threading.Lock()
+        self._plans = {}
+        self._targets = {}
+
+    def get_kind(self, file_format):
+        """
+        Returns a kind of converter accepting the format or None
+        :param file_format: str
+        :return: str
+        """
+        return self.kinds.get(file_format)
+
+    def is_output_format(self, file_format):
+        """
+        Checks if any converter can produce the format
+        :param file_format: str
+        :return: bool
+        """
+        return file_format in self.all_output_formats
+
+    def get_plans(self, old_format):
+        """
+        Finds the cheapest conversion chain from a format to every reachable format
+        Uses Dijkstra over the conversion graph, the result is cached
+        :param old_format: str
+        :return: dict
+        """
+        plans = self._plans.get(old_format)
+        if plans is not None:
+            return plans
+
+        # States are (format, kind of the step producing it), the input has no kind
+        start = (old_format, None)
+        costs = {start: 0.0}
+        previous = {}
+        queue = [(0.0, 0, start)]
+        counter = 1
+        while queue:
+            cost, _, state = heapq.heappop(queue)
+            if cost > costs[state]:
+                continue
+            file_format, kind = state
+            for step in self.graph.get(file_format, ()):
+                if kind is not None and step.kind != kind and kind not in self.chain_from[step.kind]:
+                    continue
+                new_state = (step.new_format, step.kind)
+                new_cost = cost + step.cost
+                if new_cost < costs.get(new_state, float("inf")):
+                    costs[new_state] = new_cost
+                    previous[new_state] = (state, step)
+                    heapq.heappush(queue, (new_cost, counter, new_state))
+                    counter += 1
+
+        best = {}
+        for state in previous:
+            new_format = state[0]
+            if new_format != old_format and (new_format not in best or costs[state] < costs[best[new_format]]):
+                best[new_format] = state
+
+        plans = {}
+        for new_format, state in best.items():
+            steps = []
+            while state != start:
+                state, step = previous[state]
+                steps.append(step)
+            plans[new_format] = tuple(reversed(steps))
+
+        with self._lock:
+            self._plans[old_format] = MappingProxyType(plans)
+        self.logger.debug("Planned %s conversions from %s", len(plans), old_format)
+        return self._plans[old_format]
+
+    def plan(self, old_format, new_format):
+        """
+        Returns the cheapest chain of conversion steps
+        :param old_format: str
+        :param new_format: str
+        :return: tuple
+        :raises: UnsupportedFormatException
+        """
+        steps = self.get_plans(old_format).get(new_format)
+        if not steps:
+            raise UnsupportedFormatException(f"No conversion from {old_format} to {new_format}")
+        return steps
+
+    def get_targets(self, old_format):
+        """
+        Returns formats a file can be converted to
+        Direct conversions go first in the order converters list them
+        :param old_format: str
+        :return: tuple
+        """
+        targets = self._targets.get(old_format)
+        if targets is None:
+            plans = self.get_plans(old_format)
+            targets = tuple(sorted(plans, key=lambda file_format: (len(plans[file_format]), self.order[file_format])))
+            with self._lock:
+                self._targets[old_format] = targets
+        return targets
+
+    def get_pixels(self, file_path):
+        """
+        Returns a number of pixels the converter of a file has to process
+        Unreadable files count as 0
+        :param file_path: str
+        :return: int
+        """
+        converter = self.converters.get(self.get_kind(file_path.split(".")[-1]))
+        if converter is None:
+            return 0
+        try:
+            return converter.get_pixels(file_path)
+        except Exception as e:
+            self.logger.debug("Could not measure %s: %s", file_path, e)
+            return 0
+
+    def convert(self, file_path, new_format, on_part=None, token=None):
+        """
+        Converts a file following the planned chain
+        Intermediate files are deleted
+        Parts of a split result are handed to on_part (only the last step can split)
+        The token is checked between steps and passed to every converter
+        Returns filepath of the result
+        :param file_path: str
+        :param new_format: str
+        :param on_part: callable
+        :param token: CancellationToken
+        :return: str
+        :raises: UnsupportedFormatException, ConversionCancelledException
+        """
+        steps = self.plan(file_path.split(".")[-1], new_format)
+        current_path = file_path
+        try:
+            for number, step in enumerate(steps, 1):
+                converter = self.converters[step.kind]
+                converter.check_cancelled(token)
+                new_path = converter.convert(current_path, step.new_format,
+                                             on_part if number == len(steps) else None, token)
+                if current_path != file_path:
+                    converter.delete_file(current_path)
+                current_path = new_path
+        except Exception:
+            if current_path != file_path:
+                self.converters[steps[0].kind].delete_file(current_path)
+            raise
+        return current_path
@@ -0,0 +1,229 @@
+import glob
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import resource
+import shutil
+import signal
+import time
+
+from src.converters.converter import (
+    Converter, ConversionLimitException, ConversionCancelledException, UnsupportedFormatException
+)
+from src.logger import Logger, LogPipeline
+from config import Config
+
+
+class ConversionSandbox(Config):
+    """
+    Runs conversions in a forked worker process under limits
+    The worker gets its own process group (so pandoc and frame workers are killed with it),
+    rlimits on cpu time (CONVERSION_MAX_CPU_SECONDS), address space (CONVERSION_MAX_MEMORY)
+    and written file size (CONVERSION_MAX_OUTPUT_SIZE) and is killed after CONVERSION_TIMEOUT seconds
+    A cancelled worker gets CANCELLATION_GRACE seconds to stop by itself before it is killed,
+    this is also what stops external tools like pandoc
+    Log records of the worker are sent through a pipe and written by the pipeline of the bot process
+    The worker reports temporary paths it creates, if it fails or is killed they are deleted
+    (parts already handed to on_part are kept)
+    """
+    POLL_INTERVAL = 0.5
+    LIMIT_SIGNALS = {
+        signal.SIGXCPU: "cpu time limit exceeded",
+        signal.SIGXFSZ: "output size limit exceeded",
+        signal.SIGKILL: "killed",
+    }
+
+    def __init__(self):
+        self.logger = Logger("sandbox")
+        self.context = multiprocessing.get_context("fork")
+
+    def set_limits(self):
+        """
+        Applies limits to the current process, called in the worker
+        :return: None
+        """
+        os.setsid()
+        if self.CONVERSION_NICENESS:
+            os.nice(self.CONVERSION_NICENESS)
+        limits = (
+            (resource.RLIMIT_CPU, self.CONVERSION_MAX_CPU_SECONDS),
+            (resource.RLIMIT_AS, self.CONVERSION_MAX_MEMORY),
+            (resource.RLIMIT_FSIZE, self.CONVERSION_MAX_OUTPUT_SIZE),
+        )
+        for limit, value in limits:
+            if value:
+                _, hard = resource.getrlimit(limit)
+                if hard != resource.RLIM_INFINITY:
+                    value = min(value, hard)
+                resource.setrlimit(limit, (value, hard))
+
+    def work(self, connection, log_connection, function, args, with_parts, token):
+        """
+        Worker process body, sends parts, the result or an error through the connection
+        Errors which can not be rebuilt in the bot process are sent as UnsupportedFormatException
+        :param connection: multiprocessing.connection.Connection
+        :param log_connection: multiprocessing.connection.Connection
+        :param function: callable
+        :param args: tuple
+        :param with_parts: bool
+        :param token: CancellationToken
+        :return: None
+        """
+        log_lock = self.context.Lock()
+
+        def send_record(record):
+            with log_lock:
+                log_connection.send(record)
+
+        LogPipeline.forward(send_record)
+        Converter.set_temp_callback(lambda path: connection.send(("temp", path)))
+        try:
+            self.set_limits()
+            kwargs = {"on_part": lambda path: connection.send(("part", path))} if with_parts else {}
+            if token is not None:
+                kwargs["token"] = token
+            connection.send(("result", function(*args, **kwargs)))
+        except MemoryError:
+            connection.send(("error", ConversionLimitException("memory limit exceeded")))
+        except Exception as e:
+            try:
+                pickle.loads(pickle.dumps(e))
+            except Exception:
+                e = UnsupportedFormatException(f"{type(e).__name__}: {e}")
+            connection.send(("error", e))
+        finally:
+            connection.close()
+            log_connection.close()
+
+    def run(self, function, *args, on_part=None, token=None):
+        """
+        Calls function(*args) in a limited worker process and returns its result
+        Parts sent by the worker are handed to on_part in the calling process
+        The token is passed to the function, a cancelled worker is killed after CANCELLATION_GRACE seconds
+        :param function: callable
+        :param args: tuple
+        :param on_part: callable
+        :param token: CancellationToken
+        :return: object
+        :raises: ConversionLimitException, ConversionCancelledException
+        """
+        receiver, sender = self.context.Pipe(duplex=False)
+        log_receiver, log_sender = self.context.Pipe(duplex=False)
+        process = self.context.Process(target=self.work,
+                                       args=(sender, log_sender, function, args, on_part is not None, token))
+        process.start()
+        sender.close()
+        log_sender.close()
+        self.logger.debug("Conversion worker %s started", process.pid)
+
+        deadline = time.monotonic() + self.CONVERSION_TIMEOUT
+        cancel_deadline = None
+        temp_paths = []
+        parts = set()
+        finished = False
+        try:
+            while True:
+                now = time.monotonic()
+                if token is not None and cancel_deadline is None and token.is_cancelled():
+                    cancel_deadline = now + self.CANCELLATION_GRACE
+                if cancel_deadline is not None and now >= cancel_deadline:
+                    raise ConversionCancelledException(f"Conversion worker {process.pid} cancelled")
+                remaining = deadline - now
+                if remaining <= 0:
+                    raise ConversionLimitException(f"time limit of {self.CONVERSION_TIMEOUT} s exceeded")
+                ready = multiprocessing.connection.wait([receiver, log_receiver],
+                                                        min(remaining, self.POLL_INTERVAL))
+                if log_receiver in ready:
+                    self.handle_logs(log_receiver)
+                if receiver not in ready:
+                    continue
+                try:
+                    kind, value = receiver.recv()
+                except EOFError:
+                    process.join()
+                    raise ConversionLimitException(self.describe_exit(process.exitcode))
+                if kind == "temp":
+                    temp_paths.append(value)
+                elif kind == "part":
+                    parts.add(value)
+                    on_part(value)
+                elif kind == "result":
+                    finished = True
+                    return value
+                else:
+                    raise value
+        except ConversionLimitException as e:
+            self.logger.warning(f"Conversion worker {process.pid} stopped: {e}")
+            raise
+        except ConversionCancelledException:
+            self.logger.info(f"Conversion worker {process.pid} cancelled")
+            raise
+        finally:
+            receiver.close()
+            self.kill(process)
+            self.handle_logs(log_receiver)
+            log_receiver.close()
+            if not finished:
+                self.delete_temp_paths(temp_paths, parts)
+
+    def delete_temp_paths(self, temp_paths, kept):
+        """
+        Deletes temporary folders and files (path and path.*) of a failed worker
+        :param temp_paths: list
+        :param kept: set
+        :return: None
+        """
+        deleted = 0
+        for path in temp_paths:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+                deleted += 1
+                continue
+            for file_path in [path] + glob.glob(f"{glob.escape(path)}.*"):
+                if file_path not in kept and os.path.isfile(file_path):
+                    try:
+                        os.remove(file_path)
+                        deleted += 1
+                    except OSError as e:
+                        self.logger.error(f"Error deleting file {file_path}: {e}")
+        if deleted:
+            self.logger.info(f"Deleted {deleted} temporary files of a failed conversion worker")
+
+    @staticmethod
+    def handle_logs(log_receiver):
+        """
+        Passes log records waiting in the pipe to the pipeline of this process
+        A record cut by a killed worker ends reading
+        :param log_receiver: multiprocessing.connection.Connection
+        :return: None
+        """
+        handler = LogPipeline.get_handler()
+        try:
+            while log_receiver.poll():
+                handler.handle(log_receiver.recv())
+        except (EOFError, OSError, pickle.UnpicklingError):
+            pass
+
+    def describe_exit(self, exitcode):
+        """
+        Describes why a worker exited without a result
+        :param exitcode: int
+        :return: str
+        """
+        if exitcode is not None and exitcode < 0:
+            return self.LIMIT_SIGNALS.get(-exitcode, f"killed by signal {-exitcode}")
+        return f"exited with code {exitcode}"
+
+    def kill(self, process):
+        """
+        Kills the worker process group, including processes started by the worker
+        :param process: multiprocessing.Process
+        :return: None
+        """
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            if process.is_alive():
+                process.kill()
+        process.join()
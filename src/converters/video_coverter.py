@@ -1,52 +1,364 @@
 import cv2
+import math
+import multiprocessing
+import numpy
 import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 from src.converters.converter import *
-from src.logger import Logger
+from src.converters.volume_writer import VolumeWriter
+
+
+# Frames decoded between checks of a cancellation token
+CANCELLATION_CHECK_INTERVAL = 16
+
+# Cancellation token of a frame worker process, set by the pool initializer
+# (tokens can only be inherited by forked processes, not sent with a task)
+worker_token = None
+
+
+def save_frame(folder, index, image):
+    """
+    Saves a frame as a jpeg file named by frame number
+    :param folder: str
+    :param index: int
+    :param image: numpy.ndarray
+    :return: None
+    """
+    cv2.imwrite(os.path.join(folder, f"{index}.jpeg"), image)
+
+
+def frame_segment(video_path, save, start, stop, step=1, token=None):
+    """
+    Saves every step-th frame from start to stop (exclusive) of a video with save(index, image)
+    Skipped frames are only grabbed, not retrieved
+    stop None reads until the end of a video
+    Runs in a worker process, returns numbers of saved frames
+    :param video_path: str
+    :param save: callable
+    :param start: int
+    :param stop: int
+    :param step: int
+    :param token: CancellationToken
+    :return: list
+    """
+    cv2.setNumThreads(1)
+    video = cv2.VideoCapture(video_path)
+    if start:
+        video.set(cv2.CAP_PROP_POS_FRAMES, start)
+        if int(video.get(cv2.CAP_PROP_POS_FRAMES)) != start:
+            # Inexact seek, skip frames from the beginning without decoding them
+            video.release()
+            video = cv2.VideoCapture(video_path)
+            for _ in range(start):
+                video.grab()
+
+    index = start
+    saved = []
+    while stop is None or index < stop:
+        if token is not None and index % CANCELLATION_CHECK_INTERVAL == 0:
+            token.raise_if_cancelled()
+        if not video.grab():
+            break
+        if index % step == 0:
+            success, image = video.retrieve()
+            if not success:
+                break
+            save(index, image)
+            saved.append(index)
+        index += 1
+    video.release()
+    return saved
+
+
+def init_frame_worker(token):
+    """
+    Initializer of frame worker processes
+    :param token: CancellationToken
+    :return: None
+    """
+    global worker_token
+    worker_token = token
+
+
+def frame_worker_segment(video_path, save, start, stop, step):
+    """
+    frame_segment of a frame worker process, stopped by the token of the pool
+    :param video_path: str
+    :param save: callable
+    :param start: int
+    :param stop: int
+    :param step: int
+    :return: list
+    """
+    return frame_segment(video_path, save, start, stop, step, worker_token)
+
+
+def frame_scenes(video_path, save, step, threshold, size, token=None):
+    """
+    Saves frames starting a new scene with save(index, image)
+    Every step-th frame is downscaled to a grayscale thumbnail, its brightness histogram
+    is compared to the histogram of the last saved frame
+    A frame is saved when the distance (from 0 to 1) is above the threshold
+    :param video_path: str
+    :param save: callable
+    :param step: int
+    :param threshold: float
+    :param size: tuple
+    :param token: CancellationToken
+    :return: list
+    """
+    video = cv2.VideoCapture(video_path)
+    last_histogram = None
+    index = 0
+    saved = []
+    while video.grab():
+        if token is not None and index % CANCELLATION_CHECK_INTERVAL == 0:
+            token.raise_if_cancelled()
+        if index % step == 0:
+            success, image = video.retrieve()
+            if not success:
+                break
+            thumbnail = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), size, interpolation=cv2.INTER_AREA)
+            histogram = numpy.bincount(thumbnail.ravel() >> 3, minlength=32) / thumbnail.size
+            if last_histogram is None or numpy.abs(histogram - last_histogram).sum() / 2 > threshold:
+                save(index, image)
+                last_histogram = histogram
+                saved.append(index)
+        index += 1
+    video.release()
+    return saved
 
 
 class VideoConverter(Converter):
     """
     Video Converter class used for converting videos in defined formats
     Depends on cv2 library
-
+    Besides framing can take a single frame of a video as an image (SNAPSHOT_FORMATS)
+    Framing modes (FRAME_MODES):
+        frame - every frame
+        frame_interval - a frame every FRAME_INTERVAL_SECONDS
+        frame_max - at most FRAME_MAX_COUNT evenly spaced frames
+        frame_scene - frames starting a new scene
+    A contact sheet (sheet) tiles SHEET_COLUMNS x SHEET_ROWS evenly spaced frames in one image
     """
+    LOGGER_NAME = "vid_conv"
+    KIND = "video"
+    CONVERSION_COST = 3.0
+    FRAME_MODES = {"frame": 50.0, "frame_interval": 10.0, "frame_max": 10.0, "frame_scene": 25.0}
+    SHEET_COST = 8.0
+    SNAPSHOT_FORMATS = ["jpeg", "png"]
+    AVAILABLE_INPUT_FORMATS = ["mp4", "avi"]
+    AVAILABLE_OUTPUT_FORMATS = list(FRAME_MODES) + ["sheet"] + SNAPSHOT_FORMATS
 
-    AVAILABLE_FORMATS = ["mp4", "avi", "frame"]
+    def estimate_cost(self, old_format, new_format):
+        if new_format == "sheet":
+            return self.SHEET_COST
+        return self.FRAME_MODES.get(new_format, self.CONVERSION_COST)
 
-    def __init__(self):
-        super().__init__()
-        self.logger = Logger("vid_conv")
+    def get_pixels(self, video_path):
+        video = cv2.VideoCapture(video_path)
+        pixels = int(video.get(cv2.CAP_PROP_FRAME_WIDTH)) * int(video.get(cv2.CAP_PROP_FRAME_HEIGHT)) \
+            * int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        video.release()
+        return max(pixels, 0)
 
-    def frame_video(self, video_path):
+    def convert(self, video_path, new_format, on_part=None, token=None):
         """
-        Splits a video in frames and returns a filepath of an zip archive
-        In process creates a temporary folder with every frame (deletes it when finishes)
-        Requires lots of both time and space
+        Converts a video to a specified output format
+        Frame archives are split in parts handed to on_part (see frame_video)
+        :param video_path: str
+        :param new_format: str
+        :param on_part: callable
+        :param token: CancellationToken
+        :return: str
+        :raises: UnsupportedFormatException
+        """
+        if new_format in self.FRAME_MODES:
+            return self.frame_video(video_path, new_format, on_part, token)
+        if new_format == "sheet":
+            return self.sheet_video(video_path, token)
+        if new_format in self.SNAPSHOT_FORMATS:
+            return self.snapshot_video(video_path, new_format)
+        error_message = f"Format {new_format} is not supported to convert to"
+        self.logger.error(error_message)
+        raise UnsupportedFormatException(error_message)
 
+    def snapshot_video(self, video_path, new_format):
+        """
+        Saves the middle frame of a video as an image and returns its filepath
         :param video_path: str
+        :param new_format: str
         :return: str
+        :raises: UnsupportedFormatException
         """
-        self.logger.debug(f"Framing video at {video_path}")
+        self.logger.debug("Taking snapshot of video at %s", video_path)
 
         video = cv2.VideoCapture(video_path)
-        count = 0
-        temp_folder = self.generate_temp_folder()
+        count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        if count > 1:
+            video.set(cv2.CAP_PROP_POS_FRAMES, count // 2)
         success, image = video.read()
-        while success:
-            file_path = os.path.join(temp_folder, f"{count}.jpeg")
-            cv2.imwrite(file_path, image)
+        video.release()
+        if not success:
+            raise UnsupportedFormatException(f"Could not read a frame of {video_path}")
+
+        file_path = self.generate_temp_path(new_format)
+        cv2.imwrite(file_path, image)
+        self.logger.info(f"Video at {video_path} snapshot saved at {file_path}")
+        return file_path
+
+    def sheet_video(self, video_path, token=None):
+        """
+        Creates a contact sheet of evenly spaced frames and returns its filepath
+        Tiles are downscaled as frames are decoded and written into a preallocated grid,
+        so no full resolution frame is kept
+        :param video_path: str
+        :param token: CancellationToken
+        :return: str
+        :raises: UnsupportedFormatException
+        """
+        self.logger.debug("Creating contact sheet of video at %s", video_path)
+
+        video = cv2.VideoCapture(video_path)
+        total = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if not total or not width or not height:
+            video.release()
+            raise UnsupportedFormatException(f"Could not read frames of {video_path}")
+
+        tiles = self.SHEET_COLUMNS * self.SHEET_ROWS
+        tile_width = self.SHEET_TILE_WIDTH
+        tile_height = max(1, round(height * tile_width / width))
+        sheet = numpy.zeros((tile_height * self.SHEET_ROWS, tile_width * self.SHEET_COLUMNS, 3), dtype=numpy.uint8)
+        targets = sorted({total * tile // tiles for tile in range(tiles)})
+
+        tile = 0
+        index = 0
+        for target in targets:
+            self.check_cancelled(token)
+            while index < target:
+                if not video.grab():
+                    break
+                index += 1
             success, image = video.read()
-            count += 1
+            if not success:
+                break
+            index += 1
+            row, column = divmod(tile, self.SHEET_COLUMNS)
+            sheet[row * tile_height:(row + 1) * tile_height, column * tile_width:(column + 1) * tile_width] = \
+                cv2.resize(image, (tile_width, tile_height), interpolation=cv2.INTER_AREA)
+            tile += 1
+        video.release()
 
-        arc_path = self.generate_temp_path()
-        arc_format = "zip"
+        file_path = self.generate_temp_path(self.SHEET_FORMAT)
+        cv2.imwrite(file_path, sheet)
+        self.logger.info(f"Contact sheet of {tile} frames of video at {video_path} saved at {file_path}")
+        return file_path
 
-        self.logger.debug(f"Archiving frames at {arc_path}.{arc_format}")
-        shutil.make_archive(arc_path, arc_format, temp_folder)
+    def get_frame_step(self, mode, total, fps):
+        """
+        Returns a distance between saved frames for a framing mode
+        :param mode: str
+        :param total: int
+        :param fps: float
+        :return: int
+        """
+        if mode == "frame_interval" and fps > 0:
+            return max(1, round(fps * self.FRAME_INTERVAL_SECONDS))
+        if mode == "frame_max" and total > 0:
+            return max(1, math.ceil(total / self.FRAME_MAX_COUNT))
+        return 1
 
-        self.logger.debug(f"Deleting folder at {temp_folder}")
-        shutil.rmtree(temp_folder)
+    def frame_video(self, video_path, mode="frame", on_part=None, token=None):
+        """
+        Splits a video in frames and returns a filepath of an zip archive
+        mode is one of FRAME_MODES
+        Frames are written to the archive as they are decoded
+        With on_part supplied the archive is split in volumes of at most part_size bytes,
+        every finished volume but the last is handed to on_part right away
+        Long videos are split in frame ranges decoded in parallel worker processes
+        (in a temporary folder deleted when finished), frame numbering is the same as when decoding serially
+        Framing every frame requires lots of both time and space
 
-        self.logger.info(f"Video at {video_path} framed total of: {count} frames")
-        return f"{arc_path}.{arc_format}"
+        :param video_path: str
+        :param mode: str
+        :param on_part: callable
+        :param token: CancellationToken
+        :return: str
+        :raises: ConversionCancelledException
+        """
+        self.logger.debug("Framing video at %s (%s)", video_path, mode)
+
+        video = cv2.VideoCapture(video_path)
+        total = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = video.get(cv2.CAP_PROP_FPS)
+        video.release()
+
+        volumes = VolumeWriter(self.generate_temp_path(), self.part_size, on_part)
+
+        def archive_frame(index, image):
+            volumes.writestr(f"{index}.jpeg", cv2.imencode(".jpeg", image)[1].tobytes())
+
+        step = self.get_frame_step(mode, total, fps)
+        workers = min(self.FRAME_WORKERS, total // self.FRAME_SEGMENT_MIN_FRAMES)
+        try:
+            if mode == "frame_scene":
+                step = max(1, round(fps / self.FRAME_SCENE_CHECKS_PER_SECOND)) if fps > 0 else 1
+                count = len(frame_scenes(video_path, archive_frame, step,
+                                         self.FRAME_SCENE_THRESHOLD, self.FRAME_SCENE_SIZE, token))
+            elif workers > 1:
+                count = self.frame_segments(video_path, volumes, total, step, workers, token)
+            else:
+                count = len(frame_segment(video_path, archive_frame, 0, None, step, token))
+        except Exception:
+            volumes.discard()
+            raise
+
+        arc_path = volumes.close()
+        self.logger.info(f"Video at {video_path} framed total of: {count} frames in {volumes.volume} volumes")
+        return arc_path
+
+    def frame_segments(self, video_path, volumes, total, step, workers, token=None):
+        """
+        Decodes frame ranges in forked worker processes sharing the cancellation token
+        Frames of every range are archived in order as soon as the range is done
+        On an error or cancellation pending ranges are dropped
+        and running workers are waited for before the frames folder is deleted
+        :param video_path: str
+        :param volumes: VolumeWriter
+        :param total: int
+        :param step: int
+        :param workers: int
+        :param token: CancellationToken
+        :return: int
+        """
+        temp_folder = self.generate_temp_folder()
+        bounds = [total * segment // workers for segment in range(workers)] + [None]
+        self.logger.debug("Framing %s frames in %s segments", total, workers)
+
+        count = 0
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                                     initializer=init_frame_worker, initargs=(token,)) as pool:
+                futures = [
+                    pool.submit(frame_worker_segment, video_path, partial(save_frame, temp_folder),
+                                bounds[segment], bounds[segment + 1], step)
+                    for segment in range(workers)
+                ]
+                try:
+                    for future in futures:
+                        for index in future.result():
+                            file_path = os.path.join(temp_folder, f"{index}.jpeg")
+                            volumes.write(file_path, f"{index}.jpeg")
+                            os.remove(file_path)
+                            count += 1
+                except BaseException:
+                    pool.shutdown(wait=True, cancel_futures=True)
+                    raise
+        finally:
+            self.logger.debug("Deleting folder at %s", temp_folder)
+            shutil.rmtree(temp_folder, ignore_errors=True)
+        return count
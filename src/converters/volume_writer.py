@@ -0,0 +1,94 @@
+import os
+import zipfile
+
+
+class VolumeWriter:
+    """
+    Writes entries to zip archives (volumes) of at most max_size bytes
+    When a volume is full it is closed and handed to on_volume, writing continues in the next one
+    Without on_volume everything goes to a single archive
+    Entries are stored without compression
+    """
+    END_RECORD_SIZE = 22
+    LOCAL_HEADER_SIZE = 30
+    CENTRAL_HEADER_SIZE = 46
+
+    def __init__(self, base_path, max_size=None, on_volume=None):
+        self.base_path = base_path
+        self.max_size = max_size if on_volume else None
+        self.on_volume = on_volume
+        self.volume = 0
+        self.path = None
+        self.archive = None
+        self.size = 0
+        self.entries = 0
+        self.open_volume()
+
+    def open_volume(self):
+        """
+        Starts the next volume
+        :return: None
+        """
+        self.volume += 1
+        self.path = f"{self.base_path}.part{self.volume}.zip"
+        self.archive = zipfile.ZipFile(self.path, "w", zipfile.ZIP_STORED, allowZip64=True)
+        self.size = self.END_RECORD_SIZE
+        self.entries = 0
+
+    def reserve(self, name, size):
+        """
+        Makes room for an entry, finishes the current volume if the entry does not fit
+        An entry bigger than max_size gets a volume of its own
+        :param name: str
+        :param size: int
+        :return: None
+        """
+        name_size = len(name.encode("utf-8"))
+        entry_size = self.LOCAL_HEADER_SIZE + self.CENTRAL_HEADER_SIZE + 2 * name_size + size
+        if self.max_size is not None and self.entries and self.size + entry_size > self.max_size:
+            self.archive.close()
+            self.on_volume(self.path)
+            self.open_volume()
+        self.size += entry_size
+        self.entries += 1
+
+    def writestr(self, name, data):
+        """
+        Writes bytes as an entry
+        :param name: str
+        :param data: bytes
+        :return: None
+        """
+        self.reserve(name, len(data))
+        self.archive.writestr(name, data)
+
+    def write(self, file_path, name):
+        """
+        Writes a file as an entry
+        :param file_path: str
+        :param name: str
+        :return: None
+        """
+        self.reserve(name, os.path.getsize(file_path))
+        self.archive.write(file_path, name)
+
+    def close(self):
+        """
+        Closes the last volume and returns its path
+        If nothing was split the archive is named base_path.zip
+        :return: str
+        """
+        self.archive.close()
+        if self.volume == 1:
+            os.replace(self.path, f"{self.base_path}.zip")
+            self.path = f"{self.base_path}.zip"
+        return self.path
+
+    def discard(self):
+        """
+        Closes and deletes the volume being written (finished volumes belong to on_volume)
+        :return: None
+        """
+        self.archive.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
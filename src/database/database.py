@@ -1,7 +1,10 @@
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.engine import create_engine
+from sqlalchemy.exc import IntegrityError
 
 from src.database.user import User
+from src.database.update import Update
+from src.database.timing import Timing
 from src.logger import Logger
 
 import os
@@ -22,6 +25,7 @@ class DataBase(Config):
     """
     Database class used to interact with a bot database
     Uses sqlite and stores it as a db file at the database folder
+    Sessions are thread local
     """
     def __init__(self):
         self.folder = os.path.join(self.BASE_DIR, "database")
@@ -39,7 +43,9 @@ class DataBase(Config):
         session = sessionmaker()
         session.configure(bind=self.engine)
         User.metadata.create_all(self.engine)
-        self.session = session()
+        Update.metadata.create_all(self.engine)
+        Timing.metadata.create_all(self.engine)
+        self.session = scoped_session(session)
 
     def register_user(self, telegram_id):
         """
@@ -66,7 +72,7 @@ class DataBase(Config):
                 )
             )
             self.session.commit()
-            self.logger.debug(f"User {telegram_id} registered")
+            self.logger.debug("User %s registered", telegram_id)
 
     def set_admin(self, telegram_id, is_admin=True):
         """
@@ -85,7 +91,7 @@ class DataBase(Config):
                 user.set_privileges(is_admin)
                 self.session.commit()
             else:
-                self.logger.debug(f"User {telegram_id} already admin")
+                self.logger.debug("User %s already admin", telegram_id)
         else:
             self.register_user(telegram_id)
             user = query.filter_by(telegram_id=telegram_id).first()
@@ -105,7 +111,7 @@ class DataBase(Config):
         if user:
             user.inc_stats()
             self.session.commit()
-            self.logger.debug(f"User {telegram_id} stat incremented")
+            self.logger.debug("User %s stat incremented", telegram_id)
         else:
             msg = f"No user with {telegram_id} found"
             self.logger.debug(msg)
@@ -120,10 +126,10 @@ class DataBase(Config):
         query = self.session.query(User)
         user = query.filter_by(telegram_id=telegram_id).first()
         if user:
-            self.logger.debug(f"User {telegram_id} found in database")
+            self.logger.debug("User %s found in database", telegram_id)
             return True
         else:
-            self.logger.debug(f"User {telegram_id} not found in database")
+            self.logger.debug("User %s not found in database", telegram_id)
             return False
 
     def get_admin(self, telegram_id):
@@ -136,9 +142,9 @@ class DataBase(Config):
         user = query.filter_by(telegram_id=telegram_id).first()
         if user:
             if user.get_privileges():
-                self.logger.debug(f"User {telegram_id} is admin")
+                self.logger.debug("User %s is admin", telegram_id)
                 return True
-        self.logger.debug(f"User {telegram_id} is not admin")
+        self.logger.debug("User %s is not admin", telegram_id)
         return False
 
     def get_filepath(self, telegram_id):
@@ -151,7 +157,7 @@ class DataBase(Config):
         user = query.filter_by(telegram_id=telegram_id).first()
         if user:
             filepath = user.get_last_filepath()
-            self.logger.debug(f"User {telegram_id} set  last filepath at {filepath}")
+            self.logger.debug("User %s set  last filepath at %s", telegram_id, filepath)
             return filepath
         else:
             msg = f"User {telegram_id} is not registered"
@@ -171,8 +177,115 @@ class DataBase(Config):
         if user:
             user.set_last_filepath(filepath)
             self.session.commit()
-            self.logger.debug(f"User {telegram_id} set  last filepath at {filepath}")
+            self.logger.debug("User %s set  last filepath at %s", telegram_id, filepath)
         else:
             msg = f"User {telegram_id} is not registered"
             self.logger.debug(msg)
             raise NoUserFound(msg)
+
+    def begin_update(self, bot_id, update_id, stale_after):
+        """
+        Records an update as being processed
+        Returns False if the update was already recorded,
+        an update left processing for longer than stale_after (its worker died) is taken over
+        :param bot_id: str
+        :param update_id: int
+        :param stale_after: datetime.timedelta
+        :return: bool
+        """
+        now = datetime.datetime.utcnow()
+        self.session.add(
+            Update(
+                bot_id=bot_id,
+                update_id=update_id,
+                status=Update.STATUS_PROCESSING,
+                date_received=now
+            )
+        )
+        try:
+            self.session.commit()
+        except IntegrityError:
+            self.session.rollback()
+        except Exception:
+            self.session.rollback()
+            raise
+        else:
+            self.logger.debug("Update %s of bot %s recorded", update_id, bot_id)
+            return True
+
+        try:
+            taken = self.session.query(Update).filter(
+                Update.bot_id == bot_id,
+                Update.update_id == update_id,
+                Update.status == Update.STATUS_PROCESSING,
+                Update.date_received < now - stale_after
+            ).update({Update.date_received: now}, synchronize_session=False)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        if taken:
+            self.logger.warning(f"Update {update_id} of bot {bot_id} was left processing, taken over")
+            return True
+        self.logger.debug("Update %s of bot %s is already recorded", update_id, bot_id)
+        return False
+
+    def finish_update(self, bot_id, update_id):
+        """
+        Marks a recorded update as processed
+        :param bot_id: str
+        :param update_id: int
+        :return: None
+        """
+        query = self.session.query(Update)
+        try:
+            update = query.filter_by(bot_id=bot_id, update_id=update_id).first()
+            if update:
+                update.set_done()
+                self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        if update:
+            self.logger.debug("Update %s of bot %s processed", update_id, bot_id)
+
+    def prune_updates(self, max_age):
+        """
+        Deletes updates recorded earlier than max_age ago
+        :param max_age: datetime.timedelta
+        :return: None
+        """
+        border = datetime.datetime.utcnow() - max_age
+        deleted = self.session.query(Update).filter(Update.date_received < border).delete()
+        self.session.commit()
+        self.logger.debug("Deleted %s old updates", deleted)
+
+    def get_timings(self):
+        """
+        Gets recorded timing sums
+        Returns a dict of (kind, old_format, new_format) to (samples, sums)
+        :return: dict
+        """
+        return {
+            (timing.kind, timing.old_format, timing.new_format): (timing.samples, timing.get_sums())
+            for timing in self.session.query(Timing).all()
+        }
+
+    def set_timing(self, kind, old_format, new_format, samples, sums):
+        """
+        Creates or updates timing sums of a conversion
+        :param kind: str
+        :param old_format: str
+        :param new_format: str
+        :param samples: int
+        :param sums: list
+        :return: None
+        """
+        query = self.session.query(Timing)
+        timing = query.filter_by(kind=kind, old_format=old_format, new_format=new_format).first()
+        if not timing:
+            timing = Timing(kind=kind, old_format=old_format, new_format=new_format)
+            self.session.add(timing)
+        timing.set_sums(samples, sums)
+        self.session.commit()
+        self.logger.debug("Timing of %s %s -> %s updated (%s samples)", kind, old_format, new_format, samples)
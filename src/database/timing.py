@@ -0,0 +1,51 @@
+from sqlalchemy.orm import declarative_base
+from sqlalchemy import Column, Integer, String, Float, UniqueConstraint
+
+
+class Timing(declarative_base()):
+    """
+    ORM Timing class to store decayed sums of conversion timings
+    Sums are sufficient statistics of a least squares fit
+    of seconds against input megabytes and megapixels
+    """
+    __tablename__ = "timings"
+    __table_args__ = (UniqueConstraint("kind", "old_format", "new_format"),)
+
+    SUMS = (
+        "weight", "size", "pixels",
+        "size_size", "size_pixels", "pixels_pixels",
+        "seconds", "size_seconds", "pixels_seconds",
+    )
+
+    id = Column(Integer, primary_key=True)
+    kind = Column(String)
+    old_format = Column(String)
+    new_format = Column(String)
+    samples = Column(Integer, default=0)
+    weight = Column(Float, default=0.0)
+    size = Column(Float, default=0.0)
+    pixels = Column(Float, default=0.0)
+    size_size = Column(Float, default=0.0)
+    size_pixels = Column(Float, default=0.0)
+    pixels_pixels = Column(Float, default=0.0)
+    seconds = Column(Float, default=0.0)
+    size_seconds = Column(Float, default=0.0)
+    pixels_seconds = Column(Float, default=0.0)
+
+    def get_sums(self):
+        """
+        Gets sums in the SUMS order
+        :return: list
+        """
+        return [getattr(self, name) or 0.0 for name in self.SUMS]
+
+    def set_sums(self, samples, sums):
+        """
+        Sets the number of samples and sums in the SUMS order
+        :param samples: int
+        :param sums: list
+        :return: None
+        """
+        self.samples = samples
+        for name, value in zip(self.SUMS, sums):
+            setattr(self, name, value)
@@ -0,0 +1,27 @@
+from sqlalchemy.orm import declarative_base
+from sqlalchemy import Column, Integer, String, DateTime, UniqueConstraint
+
+
+class Update(declarative_base()):
+    """
+    ORM Update class to store processed telegram updates
+    An update stays processing until it is done, a stale processing update can be taken over
+    """
+    __tablename__ = "updates"
+    __table_args__ = (UniqueConstraint("bot_id", "update_id"),)
+
+    STATUS_PROCESSING = "processing"
+    STATUS_DONE = "done"
+
+    id = Column(Integer, primary_key=True)
+    bot_id = Column(String)
+    update_id = Column(Integer)
+    status = Column(String)
+    date_received = Column(DateTime, index=True)
+
+    def set_done(self):
+        """
+        Marks the update as processed
+        :return: None
+        """
+        self.status = self.STATUS_DONE
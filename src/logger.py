@@ -1,41 +1,209 @@
+import atexit
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import threading
 
 from config import Config
 
 
-class Logger(logging.Logger, Config):
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as single line json objects
+    """
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "name": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler which puts records in the queue of the current process as they are
+    Message formatting is left to the listener thread
+    Records of a process forwarding to its parent are formatted so they can be pickled
+    """
+    def __init__(self):
+        super().__init__(None)
+
+    def prepare(self, record):
+        if LogPipeline.is_forwarding():
+            return super().prepare(record)
+        return record
+
+    def enqueue(self, record):
+        LogPipeline.put(record)
+
+
+class LogPipeline(Config):
+    """
+    Process-wide logging pipeline
+    Every logger puts records in one queue, a single listener thread
+    writes them to a rotating file and to the command line
+    Worker processes forward their records to the parent instead (see forward),
+    so only one process writes and rotates the log file
+    """
     LOGGER_FORMAT = "%(asctime)s\t%(levelname)-7s\t%(name)-8s\t%(message)s"
 
-    def __init__(self, name):
-        super().__init__(name)
-        self.add_f_handler()
-        self.add_c_handler()
+    _lock = threading.Lock()
+    _pid = None
+    _queue = None
+    _listener = None
+    _handler = None
+    _send = None
 
-    def add_f_handler(self):
+    @classmethod
+    def get_handler(cls):
         """
-        File handler
-        Creates a folder if it doesn't exist
-        Sets a level and a formatter
+        Returns the handler shared by every logger
+        :return: logging.Handler
+        """
+        if cls._handler is None:
+            with cls._lock:
+                if cls._handler is None:
+                    cls._handler = DeferredQueueHandler()
+        return cls._handler
+
+    @classmethod
+    def get_queue(cls):
+        """
+        Returns the queue of the current process
+        Starts the listener on the first call in a process (also after a fork)
+        :return: queue.SimpleQueue
+        """
+        if cls._pid != os.getpid():
+            with cls._lock:
+                if cls._pid != os.getpid():
+                    cls.start()
+        return cls._queue
+
+    @classmethod
+    def forward(cls, send):
+        """
+        Hands records of the current process (and processes forked from it) to send(record)
+        instead of the listener, send has to be safe to call from several processes
+        :param send: callable
         :return: None
         """
-        if not os.path.exists(self.LOGGING_FOLDER):
-            os.makedirs(self.LOGGING_FOLDER)
-        handler = logging.FileHandler(self.LOGGING_PATH)
-        handler.setLevel(self.LOGGING_FILE_LEVEL)
-        formatter = logging.Formatter(self.LOGGER_FORMAT)
-        handler.setFormatter(formatter)
-        self.addHandler(handler)
+        cls._send = send
 
-    def add_c_handler(self):
+    @classmethod
+    def is_forwarding(cls):
         """
-        Command line handler
-        Creates a folder if it doesn't exist
-        Sets a level and a formatter
+        :return: bool
+        """
+        return cls._send is not None
+
+    @classmethod
+    def put(cls, record):
+        """
+        Puts a record in the queue of the current process or forwards it
+        :param record: logging.LogRecord
         :return: None
         """
+        if cls._send is not None:
+            cls._send(record)
+        else:
+            cls.get_queue().put_nowait(record)
+
+    @classmethod
+    def get_level(cls):
+        """
+        The lowest level any handler accepts
+        :return: int
+        """
+        return min(cls.LOGGING_FILE_LEVEL, cls.LOGGING_COMMAND_LINE_LEVEL)
+
+    @classmethod
+    def get_formatter(cls):
+        if cls.LOGGING_JSON:
+            return JsonFormatter()
+        return logging.Formatter(cls.LOGGER_FORMAT)
+
+    @classmethod
+    def create_f_handler(cls):
+        """
+        Rotating file handler
+        Creates a folder if it doesn't exist
+        :return: logging.Handler
+        """
+        if not os.path.exists(cls.LOGGING_FOLDER):
+            os.makedirs(cls.LOGGING_FOLDER)
+        handler = logging.handlers.RotatingFileHandler(
+            cls.LOGGING_PATH,
+            maxBytes=cls.LOGGING_MAX_BYTES,
+            backupCount=cls.LOGGING_BACKUP_COUNT,
+            encoding="utf-8"
+        )
+        handler.setLevel(cls.LOGGING_FILE_LEVEL)
+        handler.setFormatter(cls.get_formatter())
+        return handler
+
+    @classmethod
+    def create_c_handler(cls):
+        """
+        Command line handler
+        :return: logging.Handler
+        """
         handler = logging.StreamHandler()
-        handler.setLevel(self.LOGGING_COMMAND_LINE_LEVEL)
-        formatter = logging.Formatter(self.LOGGER_FORMAT)
-        handler.setFormatter(formatter)
-        self.addHandler(handler)
+        handler.setLevel(cls.LOGGING_COMMAND_LINE_LEVEL)
+        handler.setFormatter(cls.get_formatter())
+        return handler
+
+    @classmethod
+    def start(cls):
+        """
+        Creates the queue and starts the listener thread
+        :return: None
+        """
+        cls._queue = queue.SimpleQueue()
+        cls._listener = logging.handlers.QueueListener(
+            cls._queue,
+            cls.create_f_handler(),
+            cls.create_c_handler(),
+            respect_handler_level=True
+        )
+        cls._listener.start()
+        cls._pid = os.getpid()
+        atexit.register(cls.stop)
+
+    @classmethod
+    def reset(cls):
+        """
+        Forgets the listener of a parent process, used after a fork
+        Forwarding is kept
+        :return: None
+        """
+        cls._lock = threading.Lock()
+        cls._pid = None
+        cls._queue = None
+        cls._listener = None
+
+    @classmethod
+    def stop(cls):
+        """
+        Flushes queued records and stops the listener
+        :return: None
+        """
+        if cls._listener and cls._pid == os.getpid():
+            cls._listener.stop()
+            cls._listener = None
+            cls._pid = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=LogPipeline.reset)
+
+
+class Logger(logging.Logger, Config):
+    def __init__(self, name):
+        super().__init__(name, LogPipeline.get_level())
+        self.addHandler(LogPipeline.get_handler())